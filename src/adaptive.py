@@ -0,0 +1,261 @@
+"""
+One front door that picks the loader
+
+    from adaptive import load
+    load(connection, beers)                       # list of api records
+    load(connection, "beers.json.zst")            # json lines file
+    load(connection, dataset, memory_budget=2**30)
+
+The candidates are the bench strategies (see bench.py) that fit the
+source and the connection's driver. They're ranked by the rows/s this
+host measured for them, taken from a bench results file:
+
+    python -m bench -o load_profile.json
+
+The measurement at the size nearest to the input is used, so a loader
+that's only good for a handful of rows only wins for a handful of rows.
+Strategies the profile doesn't know go last, in DEFAULT_ORDER. Loaders
+that build the whole load in memory are skipped when that wouldn't fit
+memory_budget. If the chosen one fails, the next one is tried. Every
+loader starts by recreating staging_beers, so a half-done attempt
+doesn't leak into the next.
+
+A strategy is only used if it loads bench's awkward round trip records
+exactly. The profile says which passed (its `verified`), the ones the
+profile has no verdict on are checked on the connection right before
+they're first tried, once per process.
+"""
+
+import io
+import json
+import math
+import os
+import time
+from collections.abc import Iterable, Sequence
+from typing import Any, NamedTuple
+
+import psycopg
+import psycopg2_implementation
+import pyarrow.parquet as pq
+from bench import Result, Strategy, check_round_trip, discover_strategies, read_results
+from dataset import BeerDataset
+from streaming import compression, open_jsonl
+from utils import EitherConnection
+
+LOAD_PROFILE = os.environ.get("LOAD_PROFILE", "load_profile.json")
+
+# the order to try strategies in when there's no measurement for them,
+# roughly what the bench runs showed so far
+DEFAULT_ORDER = (
+    "dataset.copy_dataset_pgpq",
+    "with_pgpq.copy_with_pgpq",
+    "streaming.copy_jsonl_pgpq",
+    "with_duckdb.copy_with_duckdb_arrow",
+    "dataset.copy_dataset[binary=True]",
+    "psycopg_implementation.copy_bytes_iterator",
+    "psycopg_implementation.copy_tuple_iterator",
+    "psycopg2_implementation.copy_bytes_iterator",
+    "streaming.copy_jsonl",
+    "with_duckdb.copy_with_duckdb",
+)
+
+# loaders whose memory grows with the input, and roughly how many bytes
+# they hold per byte of json input when there's no measurement
+MATERIALIZING = {
+    "copy_stringio": 2.0,
+    "insert_executemany": 3.0,
+}
+
+# bench strategies that aren't plain loads into staging_beers, or that
+# would leave rows out instead of failing
+EXCLUDED = (
+    "copy_chunked",
+    "insert_with_duckdb_attach",
+    "copy_nested",
+    "copy_tolerant",
+    "copy_incremental",
+)
+
+# strategy name -> whether check_round_trip passed, for the strategies
+# the profile has no verdict on
+_round_trips: dict[str, bool] = {}
+
+# records (or lines) looked at to guess the size of a row
+_SAMPLE = 100
+
+
+class LoadResult(NamedTuple):
+    strategy: str
+    rows: int | None  # estimated, None for a stream of unknown length
+    seconds: float
+    failures: list[tuple[str, str]]  # (strategy, error) tried before
+
+
+class SourceInfo(NamedTuple):
+    kind: str  # a bench source: "rows", "dataset", "json" or "parquet"
+    rows: int | None
+    bytes_per_row: float
+    replayable: bool  # can be read again if a strategy fails halfway
+
+
+def describe_source(source: Any) -> SourceInfo:
+    """What kind of input this is and how big, without reading all of it"""
+
+    if isinstance(source, BeerDataset):
+        rows = len(source)
+        return SourceInfo("dataset", rows, source.table.nbytes / max(rows, 1), True)
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        size = os.path.getsize(path)
+        if path.endswith(".parquet"):
+            rows = pq.ParquetFile(path).metadata.num_rows
+            return SourceInfo("parquet", rows, size / max(rows, 1), True)
+        with open_jsonl(path) as stream:
+            sample = [len(line) for line, _ in zip(io.BufferedReader(stream), range(_SAMPLE))]
+        average = sum(sample) / max(len(sample), 1)
+        # the row count of a compressed file is anybody's guess
+        rows = math.ceil(size / average) if average and not compression(path) else None
+        return SourceInfo("json", rows, average, True)
+    if isinstance(source, Sequence):
+        sample = [len(json.dumps(record)) for record in source[:_SAMPLE]]
+        return SourceInfo("rows", len(source), sum(sample) / max(len(sample), 1), True)
+    if isinstance(source, Iterable):
+        return SourceInfo("rows", None, 0.0, False)
+    msg = f"Don't know how to load a {type(source).__name__}"
+    raise TypeError(msg)
+
+
+def read_profile(path: str = LOAD_PROFILE) -> dict[str, list[Result]]:
+    """bench results by strategy name, empty if there's no profile yet"""
+
+    try:
+        results = read_results(path)
+    except FileNotFoundError:
+        return {}
+    profile: dict[str, list[Result]] = {}
+    for result in results:
+        profile.setdefault(result.strategy, []).append(result)
+    return profile
+
+
+def _nearest(results: list[Result], rows: int | None) -> Result:
+    if rows is None:
+        return max(results, key=lambda result: result.rows)
+    return min(results, key=lambda result: abs(math.log(max(result.rows, 1) / max(rows, 1))))
+
+
+def _fits(
+    strategy: Strategy, info: SourceInfo, results: list[Result], memory_budget: int | None
+) -> bool:
+    function = strategy.name.split(".", 1)[1].split("[")[0]
+    if function not in MATERIALIZING or memory_budget is None:
+        return True
+    if info.rows is None:
+        return False
+    if results:
+        largest = max(results, key=lambda result: result.rows)
+        # rss sees arrow's and duckdb's buffers too, tracemalloc only python's
+        peak_mb = max(largest.peak_memory_mb, largest.peak_rss_mb or 0.0)
+        needed = peak_mb * 2**20 * info.rows / max(largest.rows, 1)
+    else:
+        needed = MATERIALIZING[function] * info.bytes_per_row * info.rows
+    return needed <= memory_budget
+
+
+def _round_trips_ok(
+    strategy: Strategy, connection: EitherConnection, results: list[Result]
+) -> bool:
+    verdicts = {result.verified for result in results} - {None}
+    if verdicts:
+        return False not in verdicts
+    if strategy.name not in _round_trips:
+        try:
+            # None, not loading staging_beers at all, is no pass either
+            _round_trips[strategy.name] = bool(check_round_trip(strategy, connection))
+        except Exception:
+            if connection.closed:
+                raise
+            connection.rollback()
+            _round_trips[strategy.name] = False
+    return _round_trips[strategy.name]
+
+
+def rank_strategies(
+    connection: EitherConnection,
+    info: SourceInfo,
+    memory_budget: int | None = None,
+    profile: dict[str, list[Result]] | None = None,
+) -> list[Strategy]:
+    """The strategies that can load this source on this connection,
+    fastest first. The ones the profile says failed the round trip check
+    are left out"""
+
+    profile = read_profile() if profile is None else profile
+    psycopg2_connection = not isinstance(connection, psycopg.Connection)
+
+    def rows_per_sec(strategy: Strategy) -> float:
+        results = profile.get(strategy.name)
+        return _nearest(results, info.rows).rows_per_sec if results else 0.0
+
+    def default_rank(strategy: Strategy) -> int:
+        if strategy.name in DEFAULT_ORDER:
+            return DEFAULT_ORDER.index(strategy.name)
+        return len(DEFAULT_ORDER)
+
+    candidates = [
+        strategy
+        for strategy in discover_strategies()
+        if strategy.source == info.kind
+        and (strategy.open_connection is psycopg2_implementation.open_connection)
+        == psycopg2_connection
+        and not any(excluded in strategy.name for excluded in EXCLUDED)
+        # parallel_encode hands slices of the input to its workers
+        and (info.replayable or not strategy.name.startswith("parallel_encode."))
+        and _fits(strategy, info, profile.get(strategy.name, []), memory_budget)
+        and False not in {result.verified for result in profile.get(strategy.name, [])}
+    ]
+    return sorted(candidates, key=lambda strategy: (-rows_per_sec(strategy), default_rank(strategy)))
+
+
+def load(
+    connection: EitherConnection,
+    source: Any,
+    memory_budget: int | None = None,
+    profile_path: str = LOAD_PROFILE,
+) -> LoadResult:
+    """Load source into staging_beers with the fastest strategy that fits
+
+    source is a list of api records, any other iterable of them, a
+    dataset.BeerDataset, or the path of a json lines or parquet file.
+    memory_budget (bytes) rules out loaders that would hold more than
+    that at once. A one-shot iterator can't be read twice, so it only
+    gets one attempt.
+    """
+
+    info = describe_source(source)
+    profile = read_profile(profile_path)
+    strategies = rank_strategies(connection, info, memory_budget, profile)
+    if not strategies:
+        msg = f"No loader fits a {info.kind} source of {info.rows} rows in {memory_budget} bytes"
+        raise ValueError(msg)
+
+    failures: list[tuple[str, str]] = []
+    for strategy in strategies:
+        if not _round_trips_ok(strategy, connection, profile.get(strategy.name, [])):
+            failures.append((strategy.name, "failed the round trip check"))
+            continue
+        t = time.perf_counter()
+        try:
+            strategy.loader(connection, source, **strategy.kwargs)
+        except Exception as error:
+            # no other loader will do better on a dead connection
+            if connection.closed:
+                raise
+            failures.append((strategy.name, repr(error)))
+            if not info.replayable:
+                break
+            continue
+        return LoadResult(strategy.name, info.rows, time.perf_counter() - t, failures)
+
+    msg = f"Every loader failed: {failures}"
+    raise RuntimeError(msg)
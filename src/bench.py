@@ -0,0 +1,512 @@
+"""
+Benchmark runner for all the loaders
+
+    cd src
+    python -m bench --list
+    python -m bench --multipliers 1 10 100 --repeat 5 --output results.json
+    python -m bench --baseline baseline.json
+    python -m bench --synthetic 1 --multipliers 1000   # unique records
+
+Every @profile-decorated loader in the modules below is a strategy. The
+undecorated function (`__wrapped__`) is the one timed, so nothing runs
+twice. Loaders whose second argument is `beers` get a list of records,
+`dataset` a dataset.BeerDataset, and loaders with a `whichfile` argument
+get a json or parquet file. A module
+can list extra keyword arguments to try in a BENCH_VARIANTS dict, those
+show up as e.g. `copy_tuple_iterator[binary=True]`.
+
+Memory is measured twice, each in a run of its own: peak_memory_mb is
+tracemalloc's peak, what python allocated, and peak_rss_mb how far the
+resident set size went up, which is the one that sees arrow, pgpq and
+duckdb buffers. That run happens in a forked process, so what the
+strategies before it left allocated can't hide its peak (linux only,
+None elsewhere).
+
+Before any timing, every strategy loads a few synthetic records with
+awkward values (backslashes, the '|' delimiter, tabs, line breaks, a
+literal \\N, floats that aren't exact in binary) and staging_beers is
+read back: `verified` says whether it held exactly what went in, None
+for the strategies that load other tables.
+adaptive.py only picks strategies that pass.
+
+Next to the client's time and memory each result has the median of
+what the timed runs cost the server (see server_stats.py): WAL
+written, data file writes and extends, checkpoints, the size of the
+loaded table and the cpu time of the loader's backend. None where the
+server couldn't tell.
+"""
+
+import argparse
+import csv
+import inspect
+import json
+import math
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import nullcontext
+from decimal import Decimal
+from functools import lru_cache
+from types import ModuleType
+from typing import Any, NamedTuple
+
+import chunked
+import dataset
+import incremental
+import instrument
+import nested
+import parallel_encode
+import psycopg2_implementation
+import psycopg_implementation
+import server_stats
+import streaming
+import synthetic
+import tolerant
+import utils
+import with_duckdb
+import with_pgpq
+from schema import STAGING_BEERS
+from utils import EitherConnection
+
+# module -> the open_connection its loaders need
+STRATEGY_MODULES: dict[ModuleType, Callable[[], EitherConnection]] = {
+    psycopg_implementation: psycopg_implementation.open_connection,
+    psycopg2_implementation: psycopg2_implementation.open_connection,
+    with_duckdb: psycopg_implementation.open_connection,
+    with_pgpq: psycopg_implementation.open_connection,
+    chunked: psycopg_implementation.open_connection,
+    streaming: psycopg_implementation.open_connection,
+    parallel_encode: psycopg_implementation.open_connection,
+    dataset: psycopg_implementation.open_connection,
+    nested: psycopg_implementation.open_connection,
+    tolerant: psycopg_implementation.open_connection,
+    incremental: psycopg_implementation.open_connection,
+}
+
+# the insert_* loaders live in utils but work with either driver
+SHARED_LOADERS = ("psycopg_implementation", "psycopg2_implementation")
+
+
+class Strategy(NamedTuple):
+    name: str
+    loader: Callable[..., Any]
+    open_connection: Callable[[], EitherConnection]
+    source: str  # "rows", "dataset", "json" or "parquet"
+    kwargs: dict[str, Any] = {}  # noqa: RUF012
+
+
+class Result(NamedTuple):
+    strategy: str
+    multiplier: int
+    rows: int
+    repeat: int
+    median: float
+    p95: float
+    rows_per_sec: float
+    peak_memory_mb: float
+    # server costs, medians of the timed runs
+    wal_mb: float | None = None
+    write_mb: float | None = None  # data files written or extended
+    checkpoints: float | None = None
+    table_mb: float | None = None
+    backend_cpu_seconds: float | None = None
+    peak_rss_mb: float | None = None
+    verified: bool | None = None  # check_round_trip's verdict
+
+
+def _loaders_in(module: ModuleType) -> Iterator[tuple[str, Callable[..., Any]]]:
+    for name, fn in inspect.getmembers(module, inspect.isfunction):
+        if fn.__module__ == module.__name__ and hasattr(fn, "__wrapped__"):
+            yield name, fn.__wrapped__
+
+
+def _source_for(loader: Callable[..., Any]) -> str | None:
+    parameters = list(inspect.signature(loader).parameters.values())
+    if len(parameters) < 2:
+        return None
+    if parameters[1].name == "beers":
+        return "rows"
+    if parameters[1].name == "dataset":
+        return "dataset"
+    if parameters[1].name == "whichfile":
+        default = parameters[1].default
+        if isinstance(default, str) and default.endswith(".parquet"):
+            return "parquet"
+        return "json"
+    return None
+
+
+def discover_strategies() -> list[Strategy]:
+    strategies = []
+    for module, open_connection in STRATEGY_MODULES.items():
+        loaders = list(_loaders_in(module))
+        if module.__name__ in SHARED_LOADERS:
+            loaders += list(_loaders_in(utils))
+        variants = getattr(module, "BENCH_VARIANTS", {})
+        for name, loader in loaders:
+            source = _source_for(loader)
+            if source is None:
+                continue
+            for kwargs in [{}, *variants.get(name, [])]:
+                options = ",".join(f"{key}={value}" for key, value in kwargs.items())
+                strategies.append(
+                    Strategy(
+                        f"{module.__name__}.{name}" + (f"[{options}]" if options else ""),
+                        loader,
+                        open_connection,
+                        source,
+                        kwargs,
+                    )
+                )
+    return strategies
+
+
+# --> Round trip check
+
+# values that have to come back out of staging_beers as they went in
+AWKWARD_TEXT = (
+    "C:\\temp\\x41 done",
+    "a|b||c",
+    "tab\there",
+    "cr\r\nlf\n",
+    "\\N",
+    'quoted "a, b"',
+)
+AWKWARD_NUMBERS = (0.1, 4.35, 1.005, 123456.789012, -0.5)
+
+
+@lru_cache(maxsize=1)
+def round_trip_records() -> list[dict[str, Any]]:
+    """Synthetic api records with AWKWARD_TEXT and AWKWARD_NUMBERS
+    spread over their text and numeric fields. Made once (generating
+    takes a whole chunk of SyntheticBeers), so don't change them"""
+
+    records = list(synthetic.SyntheticBeers(2 * len(AWKWARD_TEXT), seed=0))
+    for n, record in enumerate(records):
+        for offset, name in enumerate(("name", "tagline", "description", "brewers_tips")):
+            record[name] = AWKWARD_TEXT[(n + offset) % len(AWKWARD_TEXT)]
+        for offset, name in enumerate(("abv", "ibu", "target_fg", "ph")):
+            record[name] = AWKWARD_NUMBERS[(n + offset) % len(AWKWARD_NUMBERS)]
+    return records
+
+
+def _comparable(rows: Iterable[Sequence[Any]]) -> list[tuple[Any, ...]]:
+    """Numbers as normalized Decimals, floats by their shortest repr, so
+    4.35 matches a NUMERIC 4.350000"""
+
+    def value(item: Any) -> Any:
+        if isinstance(item, float):
+            return Decimal(repr(item)).normalize()
+        if isinstance(item, (int, Decimal)):
+            return Decimal(item).normalize()
+        return item
+
+    return sorted((tuple(map(value, row)) for row in rows), key=repr)
+
+
+def check_round_trip(strategy: Strategy, connection: EitherConnection) -> bool | None:
+    """Load round_trip_records with strategy and read staging_beers back,
+    True if it holds exactly what went in. None if it stays empty, for
+    the strategies that load other tables (nested, incremental). The
+    strategy's errors are raised"""
+
+    records = round_trip_records()
+    with connection.cursor() as cursor:
+        utils.create_staging_table(cursor)
+    with tempfile.TemporaryDirectory() as tmp:
+        if strategy.source == "dataset":
+            data: Any = dataset.BeerDataset.from_records(records)
+        elif strategy.source in ("json", "parquet"):
+            data = os.path.join(tmp, "beers.json")
+            with_duckdb.save_beers_json(records, data)
+            if strategy.source == "parquet":
+                with_duckdb.save_beers_parquet(data, os.path.join(tmp, "beers.parquet"))
+                data = os.path.join(tmp, "beers.parquet")
+        else:
+            data = records
+        strategy.loader(connection, data, **strategy.kwargs)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {', '.join(STAGING_BEERS.names)} FROM {STAGING_BEERS.table}")
+        loaded = cursor.fetchall()
+    if not loaded:
+        return None
+    return _comparable(loaded) == _comparable(map(STAGING_BEERS.extract, records))
+
+
+def _verify(strategy: Strategy) -> bool | None:
+    connection = strategy.open_connection()
+    try:
+        verified = check_round_trip(strategy, connection)
+    except Exception as error:
+        print(f"{strategy.name:<55} round trip FAILED {error!r}", file=sys.stderr)
+        return False
+    finally:
+        connection.close()
+    if verified is None:
+        print(f"{strategy.name:<55} doesn't load staging_beers, not checked", file=sys.stderr)
+    elif not verified:
+        print(f"{strategy.name:<55} round trip gave different data", file=sys.stderr)
+    return verified
+
+
+# --> Running
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Nearest-rank percentile, good enough for a handful of repetitions.
+    0.0 for no values, e.g. an ingest service that hasn't finished a job"""
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def _call(
+    strategy: Strategy, data: Any, server: bool = False
+) -> tuple[float, dict[str, float]]:
+    """Seconds taken, and with server=True the server's costs (snapshots
+    taken around the timing)"""
+
+    connection = strategy.open_connection()
+    try:
+        with server_stats.server_costs(connection) if server else nullcontext({}) as costs:
+            t = time.perf_counter()
+            strategy.loader(connection, data, **strategy.kwargs)
+            seconds = time.perf_counter() - t
+        return seconds, costs
+    finally:
+        connection.close()
+
+
+def _send_peak_rss(strategy: Strategy, data: Any, sender: Any) -> None:
+    start = instrument.reset_peak_rss()
+    _call(strategy, data)
+    peak = instrument.peak_rss()
+    sender.send(None if start is None or peak is None else max(0, peak - start))
+
+
+def _peak_rss(strategy: Strategy, data: Any) -> int | None:
+    """How far one run pushed the resident set size up, in bytes, run in
+    a forked copy of this process. None without fork or /proc, or if the
+    run failed"""
+
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_send_peak_rss, args=(strategy, data, sender))
+    process.start()
+    sender.close()
+    try:
+        peak = receiver.recv()
+    except EOFError:
+        # it died before sending anything, the traceback is on stderr
+        peak = None
+    finally:
+        receiver.close()
+        process.join()
+    return peak
+
+
+def _median_cost(costs: Sequence[dict[str, float]], *names: str) -> float | None:
+    values = [
+        sum(cost[name] for name in names)
+        for cost in costs
+        if all(name in cost for name in names)
+    ]
+    return statistics.median(values) if values else None
+
+
+def _mb(size: float | None) -> float | None:
+    return None if size is None else size / 2**20
+
+
+def _format_mb(size: float | None) -> str:
+    return "-" if size is None else f"{size:0.1f} MiB"
+
+
+def run_strategy(
+    strategy: Strategy,
+    data: Any,
+    rows: int,
+    multiplier: int,
+    repeat: int,
+    warmup: int,
+) -> Result:
+    for _ in range(warmup):
+        _call(strategy, data)
+    times, costs = zip(*(_call(strategy, data, server=True) for _ in range(repeat)))
+
+    # tracemalloc slows allocation down a lot, so memory gets its own run
+    # rather than skewing the timed ones
+    tracemalloc.start()
+    try:
+        _call(strategy, data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    rss = _peak_rss(strategy, data)
+
+    median = statistics.median(times)
+    return Result(
+        strategy=strategy.name,
+        multiplier=multiplier,
+        rows=rows,
+        repeat=repeat,
+        median=median,
+        p95=percentile(times, 95),
+        rows_per_sec=rows / median if median else 0.0,
+        peak_memory_mb=peak / 2**20,
+        wal_mb=_mb(_median_cost(costs, "wal_bytes")),
+        write_mb=_mb(_median_cost(costs, "io_write_bytes", "io_extend_bytes")),
+        checkpoints=_median_cost(costs, "checkpoints"),
+        table_mb=_mb(_median_cost(costs, "table_bytes")),
+        backend_cpu_seconds=_median_cost(costs, "backend_cpu_seconds"),
+        peak_rss_mb=_mb(rss),
+    )
+
+
+def run_benchmarks(
+    strategies: Sequence[Strategy],
+    multipliers: Sequence[int],
+    repeat: int,
+    warmup: int,
+    synthetic_seed: int | None = None,
+) -> list[Result]:
+    """synthetic_seed swaps the repeated api data for as many unique
+    synthetic.SyntheticBeers records. They're generated before the timed
+    runs, so the generating doesn't count"""
+
+    base = utils.load_beers()
+    base_dataset = dataset.BeerDataset.from_records(base)
+    results = []
+    verified = {strategy.name: _verify(strategy) for strategy in strategies}
+    with tempfile.TemporaryDirectory() as tmp:
+        for multiplier in multipliers:
+            if synthetic_seed is None:
+                beers = base * multiplier
+                beers_dataset = base_dataset.repeat(multiplier)
+            else:
+                beers = list(synthetic.SyntheticBeers(len(base) * multiplier, synthetic_seed))
+                beers_dataset = dataset.BeerDataset.from_records(beers)
+            inputs: dict[str, Any] = {"rows": beers, "dataset": beers_dataset}
+            if any(strategy.source != "rows" for strategy in strategies):
+                inputs["json"] = os.path.join(tmp, "beers.json")
+                inputs["parquet"] = os.path.join(tmp, "beers.parquet")
+                with_duckdb.save_beers_json(beers, inputs["json"])
+                with_duckdb.save_beers_parquet(inputs["json"], inputs["parquet"])
+
+            for strategy in strategies:
+                try:
+                    result = run_strategy(
+                        strategy, inputs[strategy.source], len(beers), multiplier, repeat, warmup
+                    )
+                except Exception as error:
+                    # one broken strategy shouldn't throw away the whole sweep
+                    print(f"{strategy.name:<55} x{multiplier:<5} FAILED {error!r}", file=sys.stderr)
+                    continue
+                result = result._replace(verified=verified[strategy.name])
+                print(
+                    f"{result.strategy:<55} x{multiplier:<5} "
+                    f"median {result.median:0.4f} s  p95 {result.p95:0.4f} s  "
+                    f"{result.rows_per_sec:>12,.0f} rows/s  "
+                    f"heap {result.peak_memory_mb:0.1f} MiB  "
+                    f"rss {_format_mb(result.peak_rss_mb)}  "
+                    f"WAL {_format_mb(result.wal_mb)}  writes {_format_mb(result.write_mb)}",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    return results
+
+
+# --> Results files
+
+def write_results(results: Sequence[Result], path: str) -> None:
+    """csv if the file name ends in .csv, json otherwise"""
+
+    with open(path, "w", newline="") as fp:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(fp, fieldnames=Result._fields)
+            writer.writeheader()
+            writer.writerows(result._asdict() for result in results)
+        else:
+            json.dump([result._asdict() for result in results], fp, indent=2)
+
+
+def read_results(path: str) -> list[Result]:
+    with open(path) as fp:
+        return [Result(**record) for record in json.load(fp)]
+
+
+def find_regressions(
+    results: Sequence[Result], baseline: Sequence[Result], threshold: float
+) -> list[tuple[Result, Result]]:
+    """(current, baseline) pairs whose median got more than `threshold` slower"""
+
+    previous = {(result.strategy, result.multiplier): result for result in baseline}
+    return [
+        (result, previous[key])
+        for result in results
+        if (key := (result.strategy, result.multiplier)) in previous
+        and result.median > previous[key].median * (1 + threshold)
+    ]
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--list", action="store_true", help="list strategies and exit")
+    parser.add_argument("-s", "--strategy", action="append", default=[],
+                        help="only run strategies whose name contains this (repeatable)")
+    parser.add_argument("-m", "--multipliers", type=int, nargs="+", default=[1, 10, 100],
+                        help="dataset sizes, as multiples of the api data")
+    parser.add_argument("--synthetic", type=int, metavar="SEED",
+                        help="unique generated records instead of repeated api data")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("-w", "--warmup", type=int, default=1)
+    parser.add_argument("-o", "--output", action="append", default=[],
+                        help="write results to a .json or .csv file (repeatable)")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown that counts as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    strategies = [
+        strategy
+        for strategy in discover_strategies()
+        if not args.strategy or any(part in strategy.name for part in args.strategy)
+    ]
+    if args.list:
+        for strategy in strategies:
+            print(f"{strategy.name}  ({strategy.source})")
+        return 0
+
+    results = run_benchmarks(
+        strategies, args.multipliers, args.repeat, args.warmup, args.synthetic
+    )
+    for path in args.output:
+        write_results(results, path)
+    if not args.output:
+        json.dump([result._asdict() for result in results], sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        regressions = find_regressions(results, read_results(args.baseline), args.threshold)
+        for current, previous in regressions:
+            print(
+                f"REGRESSION {current.strategy} x{current.multiplier}: "
+                f"{previous.median:0.4f} s -> {current.median:0.4f} s",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
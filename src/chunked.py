@@ -0,0 +1,177 @@
+"""
+Chunked, resumable COPY into staging_beers
+
+The other loaders send everything in one COPY on an autocommit
+connection, so a failure near the end throws the whole load away. Here
+the rows go in chunks of `chunk_rows` rows (or about `chunk_bytes` bytes),
+and each chunk is its own transaction. That takes an autocommit
+connection (open_connection makes them), without autocommit psycopg
+turns each chunk into a savepoint of one outer transaction and nothing
+is committed before the end, so copy_chunked refuses those. The same
+transaction records the
+chunk in load_checkpoints, so the checkpoint and the data commit or roll
+back together. Running again with the same load_id picks up after the
+last committed chunk:
+
+    load_id = copy_chunked(connection, beers)            # dies halfway
+    copy_chunked(connection, beers, load_id=load_id)     # loads the rest
+
+Resuming skips rows by position, so the input has to come back in the
+same order. One load at a time per staging table.
+"""
+
+import uuid
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from typing import Any
+
+import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, metered_copy, note, phase
+from schema import STAGING_BEERS
+from utils import create_staging_table, profile
+
+CHECKPOINT_TABLE = "load_checkpoints"
+
+# a real (logged) table, the checkpoints have to survive a crash
+CHECKPOINT_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+        load_id         TEXT,
+        chunk_no        INTEGER,
+        rows_done       BIGINT,
+        bytes_done      BIGINT,
+        committed_at    TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (load_id, chunk_no)
+    );"""
+
+
+def _row_size(row: tuple) -> int:
+    # roughly what the row costs in text COPY format
+    return sum(len(str(value)) + 1 for value in row if value is not None) + len(row)
+
+
+def take_chunk(
+    rows: Iterator[tuple], chunk_rows: int, chunk_bytes: int | None = None
+) -> tuple[list[tuple], int]:
+    """The next chunk of rows and its approximate size in bytes, stopping at
+    whichever of the two limits comes first"""
+
+    if chunk_bytes is None:
+        chunk = list(islice(rows, chunk_rows))
+        return chunk, 0
+
+    chunk = []
+    size = 0
+    for row in rows:
+        chunk.append(row)
+        size += _row_size(row)
+        if len(chunk) >= chunk_rows or size >= chunk_bytes:
+            break
+    return chunk, size
+
+
+def last_checkpoint(cursor: psycopg.Cursor, load_id: str) -> tuple[int, int, int]:
+    """(chunk_no, rows_done, bytes_done) of the last committed chunk,
+    (0, 0, 0) when nothing was committed yet"""
+
+    cursor.execute(
+        f"SELECT chunk_no, rows_done, bytes_done FROM {CHECKPOINT_TABLE} "
+        "WHERE load_id = %s ORDER BY chunk_no DESC LIMIT 1",
+        (load_id,),
+    )
+    return cursor.fetchone() or (0, 0, 0)
+
+
+def _start_fresh(connection: psycopg.Connection, load_id: str) -> None:
+    with connection.transaction(), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE load_id = %s", (load_id,))
+        create_staging_table(cursor)
+
+
+@profile
+def copy_chunked(
+    connection: psycopg.Connection,
+    beers: Iterable[dict[str, Any]],
+    chunk_rows: int = 100_000,
+    chunk_bytes: int | None = None,
+    load_id: str | None = None,
+    numeric_from_float: bool = True,
+) -> str:
+    """COPY beers into staging_beers one committed chunk at a time,
+    returns the load_id to pass back in to resume
+
+    Without a load_id this is a fresh load with a new id. With one, the
+    load continues after its last checkpoint. If staging_beers doesn't
+    hold exactly the checkpointed rows (it's UNLOGGED, so a server crash
+    empties it), the load starts over instead. Either one is noted in
+    the profile record. numeric_from_float is the same as for
+    copy_tuple_iterator. connection has to be in autocommit, so each
+    chunk really commits.
+    """
+
+    if not connection.autocommit:
+        msg = "copy_chunked needs an autocommit connection to commit every chunk"
+        raise ValueError(msg)
+
+    with connection.cursor() as cursor:
+        if numeric_from_float:
+            register_float_numeric_dumpers(cursor)
+        cursor.execute(CHECKPOINT_DDL)
+
+        chunk_no = rows_done = bytes_done = 0
+        if load_id is None:
+            load_id = uuid.uuid4().hex
+        else:
+            chunk_no, rows_done, bytes_done = last_checkpoint(cursor, load_id)
+
+        if chunk_no:
+            cursor.execute(f"SELECT count(*) FROM {STAGING_BEERS.table}")
+            (staged,) = cursor.fetchone()
+            if staged != rows_done:
+                note(
+                    "restarted",
+                    f"{STAGING_BEERS.table} has {staged} rows, checkpoint says {rows_done}",
+                )
+                chunk_no = rows_done = bytes_done = 0
+
+        if chunk_no:
+            note("resumed_after_chunk", chunk_no)
+            note("resumed_after_rows", rows_done)
+        else:
+            _start_fresh(connection, load_id)
+
+        rows = map(STAGING_BEERS.extract, islice(beers, rows_done, None))
+        while True:
+            with phase("transform"):
+                chunk, size = take_chunk(rows, chunk_rows, chunk_bytes)
+            if not chunk:
+                break
+
+            chunk_no += 1
+            rows_done += len(chunk)
+            bytes_done += size
+            # whatever the COPY doesn't account for itself is the checkpoint
+            # insert and the COMMIT at the end of the transaction block
+            with phase("commit"), connection.transaction():
+                with metered_copy(cursor, STAGING_BEERS.copy_statement()) as copy:
+                    copy.set_types(STAGING_BEERS.types)
+                    for row in chunk:
+                        copy.write_row(row)
+                cursor.execute(
+                    f"INSERT INTO {CHECKPOINT_TABLE}"
+                    "(load_id, chunk_no, rows_done, bytes_done) "
+                    "VALUES (%s, %s, %s, %s)",
+                    (load_id, chunk_no, rows_done, bytes_done),
+                )
+            add_rows(len(chunk))
+
+    return load_id
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_chunked": [
+        {"chunk_rows": 10_000},
+        {"chunk_bytes": 4 * 2**20},
+    ],
+}
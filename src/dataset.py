@@ -0,0 +1,154 @@
+"""
+The beers as columns instead of a list of dicts
+
+A list of api dicts costs a dict per row (plus the nested volume dict),
+and every loader pays 17 key lookups per row to pull the staging columns
+back out. BeerDataset keeps the staging_beers columns, already cleaned
+and typed, in an arrow table:
+
+    dataset = BeerDataset.from_jsonl("beers.json").repeat(100)
+    for row in dataset:              # BeerRow named tuples, table order
+        copy.write_row(row)
+    dataset.to_batches()             # or whole columns at a time
+
+repeat() shares the column buffers, so 100 copies of the data cost
+about as much memory as one.
+"""
+
+from collections import namedtuple
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from float_numeric import register_float_numeric_dumpers
+from instrument import metered_copy, phased
+from schema import STAGING_BEERS
+from streaming import iter_jsonl_batches
+from transforms import ARROW_TYPES, STAGING_SCHEMA, cast_batch, raw_json_schema, to_staging_batch
+from typing_extensions import Self
+from utils import PUNKAPI_URL, create_staging_table, crawl_beers, profile
+from with_pgpq import copy_batches
+
+# staging_beers columns as held in memory. NUMERIC stays float64, like
+# the api sends it, the decimal cast happens when encoding
+DATASET_SCHEMA = pa.schema(
+    [
+        (column.name, pa.float64() if column.type == "numeric" else ARROW_TYPES[column.type])
+        for column in STAGING_BEERS.columns
+    ]
+)
+
+# a row is a plain tuple in staging_beers order (no __dict__), so it can
+# go straight to write_row, with attribute access on top
+BeerRow = namedtuple("BeerRow", STAGING_BEERS.names)
+
+
+class BeerDataset:
+    def __init__(self: Self, table: pa.Table) -> None:
+        self.table = table.cast(DATASET_SCHEMA)
+
+    @classmethod
+    def from_batches(cls: type[Self], batches: Iterable[pa.RecordBatch]) -> Self:
+        """From batches of raw api records"""
+
+        converted = [to_staging_batch(batch, DATASET_SCHEMA) for batch in batches]
+        return cls(pa.Table.from_batches(converted, schema=DATASET_SCHEMA))
+
+    @classmethod
+    def from_records(cls: type[Self], records: Iterable[dict[str, Any]]) -> Self:
+        table = pa.Table.from_pylist(list(records), schema=raw_json_schema())
+        return cls.from_batches(table.to_batches())
+
+    @classmethod
+    def from_api(
+        cls: type[Self], page_size: int = 80, workers: int = 8, url: str = PUNKAPI_URL
+    ) -> Self:
+        return cls.from_records(crawl_beers(page_size, workers, url))
+
+    @classmethod
+    def from_jsonl(cls: type[Self], path: str) -> Self:
+        """json lines of api records, plain or compressed (see streaming.py)"""
+
+        return cls.from_batches(iter_jsonl_batches(path))
+
+    @classmethod
+    def from_parquet(cls: type[Self], path: str) -> Self:
+        """A parquet file of api records, as save_beers_parquet writes them"""
+
+        return cls.from_batches(pq.read_table(path).to_batches())
+
+    def __len__(self: Self) -> int:
+        return self.table.num_rows
+
+    def __iter__(self: Self) -> Iterator[BeerRow]:
+        return self.rows()
+
+    def repeat(self: Self, times: int) -> Self:
+        return type(self)(pa.concat_tables([self.table] * times))
+
+    def column(self: Self, name: str) -> pa.ChunkedArray:
+        return self.table.column(name)
+
+    def to_batches(self: Self, batch_size: int = 65_536) -> Iterator[pa.RecordBatch]:
+        """batch_size rows at a time. A repeat()ed table is made of many
+        small chunks, which would make for many small batches, so each
+        batch is put together from a slice (copying one batch's worth)"""
+
+        for offset in range(0, len(self), batch_size):
+            yield from self.table.slice(offset, batch_size).combine_chunks().to_batches()
+
+    def rows(self: Self, batch_size: int = 65_536) -> Iterator[BeerRow]:
+        """Rows as BeerRow tuples, converted to python a batch at a time"""
+
+        for batch in self.to_batches(batch_size):
+            yield from map(BeerRow, *(column.to_pylist() for column in batch.columns))
+
+
+# --> Loaders
+
+@profile
+def copy_dataset(
+    connection: psycopg.Connection,
+    dataset: BeerDataset,
+    binary: bool = False,
+    numeric_from_float: bool = True,
+) -> None:
+    """copy_tuple_iterator without the per-row extract, the rows already
+    are in table order"""
+
+    with connection.cursor() as cursor:
+        if numeric_from_float:
+            register_float_numeric_dumpers(cursor)
+        create_staging_table(cursor)
+
+        with metered_copy(
+            cursor, STAGING_BEERS.copy_statement("FORMAT BINARY" if binary else "")
+        ) as copy:
+            copy.set_types(STAGING_BEERS.types)
+            for row in phased("transform", dataset.rows(), count_rows=True):
+                copy.write_row(row)
+
+
+@profile
+def copy_dataset_pgpq(
+    connection: psycopg.Connection, dataset: BeerDataset, batch_size: int = 65_536
+) -> None:
+    """Whole columns through pgpq, nothing per row in python"""
+
+    create_staging_table(connection)
+    with connection.cursor() as cursor:
+        copy_batches(
+            cursor,
+            dataset.to_batches(batch_size),
+            convert=lambda batch: cast_batch(batch, STAGING_SCHEMA),
+        )
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_dataset": [
+        {"binary": True},
+    ],
+}
@@ -0,0 +1,88 @@
+"""
+The api gives us floats, the table has NUMERIC columns. psycopg only dumps
+int and Decimal to numeric, so normally every float would have to become
+a Decimal first. These dumpers write floats straight into the numeric
+text or binary wire format instead.
+
+Register them on a connection or cursor before set_types():
+
+    register_float_numeric_dumpers(cursor)
+"""
+
+import struct
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any
+
+from psycopg.abc import AdaptContext, Buffer
+from psycopg.types.numeric import (
+    NumericBinaryDumper,
+    NumericDumper,
+    dump_decimal_to_numeric_binary,
+)
+
+_HEAD = struct.Struct("!HhHH")  # ndigits, weight, sign, dscale
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = _HEAD.pack(0, 0, 0xC000, 0)
+
+
+@lru_cache(maxsize=65536)
+def float_to_numeric_binary(value: float) -> bytes:
+    """repr() gives the shortest digits that round-trip, which is the same
+    number the text COPY paths send. Pack those digits as base-10000
+    groups without building a Decimal. Columns like abv only have a few
+    distinct values, so the results are cached too."""
+
+    if value != value:
+        return NUMERIC_NAN
+    text = repr(value)
+    if "e" in text or "n" in text:
+        # 1e-07, inf: rare enough to take the slow road
+        return bytes(dump_decimal_to_numeric_binary(Decimal(text)))
+
+    sign = NUMERIC_POS
+    if text[0] == "-":
+        sign = NUMERIC_NEG
+        text = text[1:]
+    whole, _, fraction = text.partition(".")
+    dscale = len(fraction)
+
+    # pad the fraction out to whole base-10000 digits, then peel groups off
+    # the scaled integer, least significant first
+    pad = -dscale % 4
+    scaled = int(whole + fraction + "0" * pad)
+    groups = []
+    while scaled:
+        scaled, group = divmod(scaled, 10_000)
+        groups.append(group)
+    if not groups:
+        return _HEAD.pack(0, 0, NUMERIC_POS, dscale)
+
+    weight = len(groups) - (dscale + pad) // 4 - 1
+    while groups[0] == 0:
+        del groups[0]
+    groups.reverse()
+    return struct.pack(f"!HhHH{len(groups)}H", len(groups), weight, sign, dscale, *groups)
+
+
+class FloatNumericDumper(NumericDumper):
+    def dump(self, obj: Any) -> Buffer | None:
+        if type(obj) is float:
+            return repr(obj).encode() if obj == obj else b"NaN"
+        return super().dump(obj)
+
+
+class FloatNumericBinaryDumper(NumericBinaryDumper):
+    def dump(self, obj: Any) -> Buffer | None:
+        if type(obj) is float:
+            return float_to_numeric_binary(obj)
+        return super().dump(obj)
+
+
+def register_float_numeric_dumpers(context: AdaptContext) -> None:
+    """Use the float-aware dumpers wherever the target type is known to be
+    numeric (COPY after set_types), for both text and binary"""
+
+    context.adapters.register_dumper(None, FloatNumericDumper)
+    context.adapters.register_dumper(None, FloatNumericBinaryDumper)
@@ -0,0 +1,263 @@
+"""
+Incremental loads: only what changed since the last one goes to the server
+
+Every other loader empties staging_beers and sends all of it again, though
+most of a daily feed is what came yesterday, and get_beers' data is the
+same few hundred records over and over. copy_incremental keeps `beers`
+(the keyed table merge.py fills) up to date from a full feed, with an
+index of a 64 bit hash of every key's row:
+
+    key in the feed, not in the index       insert
+    key in the index with another hash      update
+    key in the index with the same hash     skipped
+    key seen before in this feed            skipped if it's the same row,
+                                            otherwise the last copy wins
+    key in the index, not in the feed       delete (deletes=True)
+
+The skipping happens before anything is encoded, so an unchanged record
+costs its extract and a hash. What's left is COPYed into a temp table and
+applied to `beers` in one transaction, together with the index, which is
+the beers_hashes side table, or a file of (key, hash) int64 pairs:
+
+    result = copy_incremental(connection, beers)
+    result = copy_incremental(connection, beers, index_path="beers.hashes")
+
+The file is written after the commit. If that doesn't happen, the next
+load sends some rows again that the upsert then leaves alone, nothing
+worse. Deletes only know the keys in the index. rebuild=True doesn't
+trust it: every row is sent, the keys come from `beers` itself, so the
+ones not in the feed are deleted (always, deletes=False can't go with
+it), and the index is written over.
+"""
+
+import hashlib
+import os
+import pickle
+import time
+from array import array
+from collections.abc import Iterable
+from typing import Any, NamedTuple
+
+import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, metered_copy, phase, phased
+from merge import create_target_table, upsert_statement
+from schema import BEERS, Column, TableSpec
+from typing_extensions import Self
+from utils import profile
+
+
+class IncrementalResult(NamedTuple):
+    records: int
+    duplicates: int  # keys that came again later in the same feed
+    unchanged: int
+    inserted: int
+    updated: int
+    deleted: int
+    seconds: float
+
+    @property
+    def skipped(self: Self) -> int:
+        return self.duplicates + self.unchanged
+
+    @property
+    def skip_ratio(self: Self) -> float:
+        """Share of the records that didn't have to be sent"""
+
+        return self.skipped / self.records if self.records else 0.0
+
+
+def row_hash(row: tuple) -> int:
+    """64 bits of blake2b of the pickled row, signed to fit a bigint. The
+    same row hashes the same in every process, unlike hash(). pickle is
+    about twice as fast as repr for the floats and dates"""
+
+    digest = hashlib.blake2b(pickle.dumps(row, protocol=5), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _key_position(target: TableSpec) -> int:
+    if len(target.primary_key) != 1:
+        msg = f"{target.table} needs a single column primary key, not {target.primary_key}"
+        raise ValueError(msg)
+    return target.names.index(target.primary_key[0])
+
+
+def hashes_table(target: TableSpec = BEERS) -> TableSpec:
+    key = target.columns[_key_position(target)]
+    return TableSpec(
+        f"{target.table}_hashes",
+        [key, Column("content_hash", "bigint")],
+        unlogged=False,
+        primary_key=[key.name],
+    )
+
+
+# --> The index, in a side table or a file
+
+def read_index(
+    cursor: psycopg.Cursor, target: TableSpec = BEERS, path: str | None = None
+) -> dict[Any, int]:
+    """key -> row hash of what's in target, empty the first time"""
+
+    if path is not None:
+        if not os.path.exists(path):
+            return {}
+        pairs = array("q")
+        with open(path, "rb") as fp:
+            pairs.frombytes(fp.read())
+        return dict(zip(pairs[::2], pairs[1::2]))
+
+    hashes = hashes_table(target)
+    cursor.execute(hashes.ddl(replace=False))
+    with cursor.copy(f"COPY {hashes.table} TO STDOUT (FORMAT BINARY)") as copy:
+        copy.set_types(hashes.types)
+        return dict(copy.rows())
+
+
+def read_keys(cursor: psycopg.Cursor, target: TableSpec = BEERS) -> dict[Any, None]:
+    """Every key in target, as an index no row's hash matches"""
+
+    key = target.columns[_key_position(target)]
+    with cursor.copy(f"COPY {target.table} ({key.name}) TO STDOUT (FORMAT BINARY)") as copy:
+        copy.set_types([key.type])
+        return dict.fromkeys(value for (value,) in copy.rows())
+
+
+def write_index(index: dict[Any, int], path: str) -> None:
+    """All of it, through a temporary file so a crash leaves the old one"""
+
+    pairs = array("q")
+    for key, content_hash in index.items():
+        pairs.append(key)
+        pairs.append(content_hash)
+    with open(path + ".tmp", "wb") as fp:
+        pairs.tofile(fp)
+    os.replace(path + ".tmp", path)
+
+
+def write_hashes(
+    cursor: psycopg.Cursor,
+    hashes: TableSpec,
+    changes: TableSpec,
+    removed: list[Any],
+    replace: bool = False,
+) -> None:
+    """Bring the side table in line, in the load's transaction"""
+
+    key_name = hashes.names[0]
+    cursor.execute(hashes.ddl(replace=replace))
+    cursor.execute(
+        f"INSERT INTO {hashes.table} SELECT {key_name}, content_hash "
+        f"FROM {changes.table} ON CONFLICT ({key_name}) "
+        "DO UPDATE SET content_hash = EXCLUDED.content_hash"
+    )
+    if removed:
+        cursor.execute(f"DELETE FROM {hashes.table} WHERE {key_name} = ANY(%s)", (removed,))
+
+
+# --> Loaders
+
+@profile
+def copy_incremental(
+    connection: psycopg.Connection,
+    beers: Iterable[dict[str, Any]],
+    target: TableSpec = BEERS,
+    index_path: str | None = None,
+    deletes: bool = True,
+    rebuild: bool = False,
+) -> IncrementalResult:
+    """Bring target in line with beers, a full feed, sending only the
+    rows that changed
+
+    index_path keeps the index in a file instead of the side table.
+    deletes=False leaves rows whose key isn't in the feed alone, for a
+    feed that's only part of the data. rebuild=True sends every row and
+    starts the index over from the keys in target, so what's there
+    counts as updated, or deleted if the feed doesn't have it. It needs
+    deletes, a row the feed doesn't have would be left without a hash.
+    """
+
+    if rebuild and not deletes:
+        msg = "rebuild=True needs deletes=True, the index has to cover every row of the target"
+        raise ValueError(msg)
+    start = time.perf_counter()
+    key_at = _key_position(target)
+    changes = TableSpec(
+        f"{target.table}_changes", [*target.columns, Column("content_hash", "bigint")]
+    )
+    hashes = hashes_table(target)
+
+    with connection.cursor() as cursor:
+        register_float_numeric_dumpers(cursor)
+        with phase("index"):
+            create_target_table(cursor, target)
+            index: dict[Any, int | None] = (
+                read_keys(cursor, target) if rebuild else read_index(cursor, target, index_path)
+            )
+
+        # key -> hash() of its latest row in the feed, a lot cheaper than
+        # row_hash for telling a repeat of the same row, and the rows to send
+        seen: dict[Any, int] = {}
+        changed: dict[Any, tuple] = {}
+        records = 0
+        with phase("hash"):
+            for row in phased("transform", map(target.extract, beers)):
+                records += 1
+                key = row[key_at]
+                quick_hash = hash(row)
+                if seen.get(key) == quick_hash:
+                    continue
+                seen[key] = quick_hash
+                content_hash = row_hash(row)
+                if content_hash == index.get(key):
+                    # back to what's stored, after another copy earlier in the feed
+                    changed.pop(key, None)
+                else:
+                    changed[key] = (*row, content_hash)
+            removed = [key for key in index if key not in seen] if deletes else []
+            inserted = sum(1 for key in changed if key not in index)
+
+        with phase("commit"), connection.transaction():
+            cursor.execute(
+                f"CREATE TEMP TABLE {changes.table} (LIKE {target.table}, "
+                "content_hash BIGINT) ON COMMIT DROP"
+            )
+            with metered_copy(cursor, changes.copy_statement()) as copy:
+                copy.set_types(changes.types)
+                for row in changed.values():
+                    copy.write_row(row)
+            cursor.execute(upsert_statement(target, changes))
+            if removed:
+                key_name = target.primary_key[0]
+                cursor.execute(
+                    f"DELETE FROM {target.table} WHERE {key_name} = ANY(%s)", (removed,)
+                )
+            if index_path is None:
+                write_hashes(cursor, hashes, changes, removed, replace=rebuild)
+        add_rows(len(changed) + len(removed))
+
+    if index_path is not None:
+        with phase("index"):
+            for key in removed:
+                del index[key]
+            index.update((key, row[-1]) for key, row in changed.items())
+            write_index(index, index_path)
+
+    return IncrementalResult(
+        records=records,
+        duplicates=records - len(seen),
+        unchanged=len(seen) - len(changed),
+        inserted=inserted,
+        updated=len(changed) - inserted,
+        deleted=len(removed),
+        seconds=time.perf_counter() - start,
+    )
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_incremental": [
+        {"rebuild": True},
+    ],
+}
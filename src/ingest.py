@@ -0,0 +1,332 @@
+"""
+A long-running ingest service, for many small loads at once
+
+The loaders are one-shot calls on a connection somebody just opened,
+which is fine for one big load. For producers that each send batches of
+a few hundred records, opening the connection costs about as much as
+the COPY. IngestService keeps a pool of connections open
+(psycopg_pool, pip install 'fast-load-experiments[pool]'), takes jobs
+from any number of threads and runs them on its workers:
+
+    with IngestService() as service:
+        future = service.submit(records)           # any iterable of api records
+        future = service.submit("beers.json.zst")  # or a json lines/parquet file
+        future.result()                            # JobResult, with its latencies
+        service.stats()
+
+Jobs wait in a queue of at most `max_queue`, after that submit blocks
+(or raises queue.Full after its timeout), so producers can't get ahead
+of the database by more than that. Once close() has started submit
+raises RuntimeError, every job taken before that still runs. Each job
+is one binary COPY, appended to staging_beers: the service never drops
+it, unlike the loaders, so don't run those against the same database at
+the same time.
+
+    python -m ingest --producers 8 --jobs 400 --batch-rows 200
+    python -m ingest --producers 8 --jobs 400 --batch-rows 200 --one-shot
+
+runs a load test, the second one with a new connection per job instead.
+"""
+
+import argparse
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+import psycopg
+import pyarrow.parquet as pq
+from bench import percentile
+from float_numeric import register_float_numeric_dumpers
+from psycopg_pool import ConnectionPool
+from schema import STAGING_BEERS, TableSpec
+from streaming import iter_jsonl
+from typing_extensions import Self
+from utils import load_beers
+
+CONNINFO = os.environ.get("INGEST_CONNINFO", "host=localhost dbname=testload user=jlc")
+
+# how many of the latest jobs the latency percentiles are over
+LATENCY_WINDOW = 10_000
+
+# sent down the queue to stop a worker
+_STOP: Any = object()
+
+
+class JobResult(NamedTuple):
+    job_id: int
+    rows: int
+    queued_seconds: float  # submit to a worker picking it up
+    load_seconds: float  # getting a connection, reading the source, COPY
+
+    @property
+    def latency(self: Self) -> float:
+        return self.queued_seconds + self.load_seconds
+
+
+class IngestStats(NamedTuple):
+    submitted: int
+    completed: int
+    failed: int
+    rows: int
+    queue_depth: int
+    max_queue_depth: int
+    latency_p50: float
+    latency_p95: float
+    queued_p50: float
+    queued_p95: float
+    pool: dict[str, int]  # psycopg_pool's get_stats()
+
+
+class _Job(NamedTuple):
+    job_id: int
+    source: Any
+    submitted: float
+    future: Future
+
+
+def iter_records(source: Any) -> Iterator[dict[str, Any]]:
+    """The api records of a job: a json lines or parquet file, or an
+    iterable of records"""
+
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if path.endswith(".parquet"):
+            for batch in pq.ParquetFile(path).iter_batches():
+                yield from batch.to_pylist()
+        else:
+            yield from iter_jsonl(path)
+    else:
+        yield from source
+
+
+def copy_records(
+    connection: psycopg.Connection, records: Iterable[dict[str, Any]], table: TableSpec
+) -> int:
+    """Append records to table with one binary COPY, returns the rows"""
+
+    rows = 0
+    with connection.cursor() as cursor:
+        with cursor.copy(table.copy_statement("FORMAT BINARY")) as copy:
+            copy.set_types(table.types)
+            for row in map(table.extract, records):
+                copy.write_row(row)
+                rows += 1
+    return rows
+
+
+def _configure(connection: psycopg.Connection) -> None:
+    # binary COPY of the api's floats into numeric columns
+    register_float_numeric_dumpers(connection)
+
+
+class IngestService:
+    def __init__(
+        self: Self,
+        conninfo: str = CONNINFO,
+        workers: int = 4,
+        max_queue: int = 64,
+        table: TableSpec = STAGING_BEERS,
+    ) -> None:
+        self.table = table
+        self.pool = ConnectionPool(
+            conninfo,
+            min_size=workers,
+            max_size=workers,
+            kwargs={"autocommit": True},
+            configure=_configure,
+            open=False,
+            name="ingest",
+        )
+        # a slot per queued job, the queue itself is unbounded so close()
+        # can always add the workers' _STOPs
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._jobs: queue.Queue[_Job] = queue.Queue()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"ingest-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._submitted = self._completed = self._failed = self._rows = 0
+        self._max_queue_depth = 0
+        self._latencies: deque[tuple[float, float]] = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self: Self, timeout: float = 30.0) -> None:
+        """Open every connection before taking jobs, so the first ones don't
+        pay for it, and make sure the table is there"""
+
+        self.pool.open(wait=True, timeout=timeout)
+        with self.pool.connection() as connection:
+            connection.execute(self.table.ddl(replace=False))
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self: Self, source: Any, timeout: float | None = None) -> Future:
+        """Queue a load of source, a file path or an iterable of records.
+        Blocks while the queue is full, raises queue.Full if it still is
+        after timeout, and RuntimeError once the service is closing. The
+        future's result is a JobResult"""
+
+        if not self._slots.acquire(timeout=timeout):
+            raise queue.Full
+        # checked and queued under the lock close() takes, so no job gets
+        # in behind the workers' _STOPs
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                msg = "The ingest service is closed"
+                raise RuntimeError(msg)
+            job = _Job(next(self._ids), source, time.perf_counter(), Future())
+            self._jobs.put_nowait(job)
+            self._submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._jobs.qsize())
+        return job.future
+
+    def _work(self: Self) -> None:
+        while (job := self._jobs.get()) is not _STOP:
+            self._slots.release()
+            if job.future.set_running_or_notify_cancel():
+                self._run(job)
+
+    def _run(self: Self, job: _Job) -> None:
+        started = time.perf_counter()
+        try:
+            with self.pool.connection() as connection:
+                rows = copy_records(connection, iter_records(job.source), self.table)
+        except Exception as error:
+            with self._lock:
+                self._failed += 1
+            job.future.set_exception(error)
+            return
+        result = JobResult(
+            job.job_id, rows, started - job.submitted, time.perf_counter() - started
+        )
+        with self._lock:
+            self._completed += 1
+            self._rows += rows
+            self._latencies.append((result.latency, result.queued_seconds))
+        job.future.set_result(result)
+
+    def stats(self: Self) -> IngestStats:
+        with self._lock:
+            latencies = [latency for latency, _ in self._latencies]
+            queued = [queued for _, queued in self._latencies]
+            return IngestStats(
+                submitted=self._submitted,
+                completed=self._completed,
+                failed=self._failed,
+                rows=self._rows,
+                queue_depth=self._jobs.qsize(),
+                max_queue_depth=self._max_queue_depth,
+                latency_p50=percentile(latencies, 50),
+                latency_p95=percentile(latencies, 95),
+                queued_p50=percentile(queued, 50),
+                queued_p95=percentile(queued, 95),
+                pool=self.pool.get_stats(),
+            )
+
+    def close(self: Self) -> None:
+        """Finish the queued jobs, then stop the workers and the pool"""
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for worker in self._workers:
+            if worker.is_alive():
+                self._jobs.put(_STOP)
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
+        self.pool.close()
+
+    def __enter__(self: Self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self: Self, *exc: object) -> None:
+        self.close()
+
+
+# --> Load test
+
+def _one_shot(conninfo: str, records: list[dict[str, Any]], table: TableSpec) -> JobResult:
+    """A job the way the loaders do it, on a connection of its own"""
+
+    t = time.perf_counter()
+    with psycopg.connect(conninfo, autocommit=True) as connection:
+        _configure(connection)
+        rows = copy_records(connection, records, table)
+    return JobResult(0, rows, 0.0, time.perf_counter() - t)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m ingest", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conninfo", default=CONNINFO)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--producers", type=int, default=8)
+    parser.add_argument("--jobs", type=int, default=400, help="in total, over all producers")
+    parser.add_argument("--batch-rows", type=int, default=200)
+    parser.add_argument("--one-shot", action="store_true",
+                        help="a new connection per job, no service")
+    args = parser.parse_args(argv)
+
+    base = load_beers()
+    batch = (base * (args.batch_rows // len(base) + 1))[: args.batch_rows]
+    with psycopg.connect(args.conninfo, autocommit=True) as connection:
+        connection.execute(STAGING_BEERS.ddl())
+
+    t = time.perf_counter()
+    if args.one_shot:
+        with ThreadPoolExecutor(max_workers=args.producers) as producers:
+            results = list(
+                producers.map(
+                    lambda _: _one_shot(args.conninfo, batch, STAGING_BEERS), range(args.jobs)
+                )
+            )
+        seconds = time.perf_counter() - t
+        latencies = [result.latency for result in results]
+        print(
+            f"{args.jobs} jobs in {seconds:0.3f} s, {args.jobs / seconds:0.0f} jobs/s, "
+            f"{args.jobs * args.batch_rows / seconds:,.0f} rows/s, latency "
+            f"p50 {percentile(latencies, 50) * 1000:0.1f} ms "
+            f"p95 {percentile(latencies, 95) * 1000:0.1f} ms"
+        )
+        return 0
+
+    with IngestService(args.conninfo, args.workers, args.max_queue) as service:
+        t = time.perf_counter()
+
+        def produce(jobs: int) -> list[Future]:
+            return [service.submit(batch) for _ in range(jobs)]
+
+        shares = [args.jobs // args.producers] * args.producers
+        shares[0] += args.jobs - sum(shares)
+        with ThreadPoolExecutor(max_workers=args.producers) as producers:
+            futures = [future for part in producers.map(produce, shares) for future in part]
+        for future in futures:
+            future.result()
+        seconds = time.perf_counter() - t
+        stats = service.stats()
+    print(
+        f"{stats.completed} jobs in {seconds:0.3f} s, {stats.completed / seconds:0.0f} jobs/s, "
+        f"{stats.rows / seconds:,.0f} rows/s, latency "
+        f"p50 {stats.latency_p50 * 1000:0.1f} ms p95 {stats.latency_p95 * 1000:0.1f} ms, "
+        f"queued p50 {stats.queued_p50 * 1000:0.1f} ms p95 {stats.queued_p95 * 1000:0.1f} ms, "
+        f"max queue depth {stats.max_queue_depth}, {stats.failed} failed"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
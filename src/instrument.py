@@ -0,0 +1,319 @@
+"""
+Single-run instrumentation for the loaders
+
+A loader run is one RunRecord. Inside it, time is split into phases:
+
+    transform   api record -> row tuple (STAGING_BEERS.extract, date parsing)
+    encode      row -> COPY/INSERT bytes (csv joins, write_row, arrow encoding)
+    wire        sending data to the server
+    commit      end of COPY / waiting for the server to finish
+    other       anything not inside a phase (DDL, connection setup, ...)
+
+measure can also take a context manager to wrap around the run, outside
+of the timing, like server_stats.server_costs: whatever dict it hands
+out ends up in the record as "server". Loaders can note() what they
+decided on the way, like a tuned batch size, that goes in "notes".
+
+peak_memory_mb is tracemalloc's peak, which only sees what python
+allocates: arrow, pgpq and duckdb buffers don't show up in it. They do
+in peak_rss_mb, how far the resident set size got above where the run
+started. That needs linux's /proc, and it's for the whole process, so
+other threads' memory counts too.
+
+Phases nest and are exclusive, so when write_row flushes a buffer the
+flush counts as wire and not as encode. When no run is being recorded
+all the helpers hand back their argument untouched, so loaders called
+outside of @profile pay nothing.
+"""
+
+import json
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any
+
+import psycopg
+from psycopg.copy import LibpqWriter
+from typing_extensions import Self
+
+# every finished record, and optionally a json lines file to append them to
+RECORDS: list[dict[str, Any]] = []
+PROFILE_LOG = os.environ.get("PROFILE_LOG")
+
+
+class RunRecord:
+    def __init__(self: Self, name: str, kwargs: dict[str, Any]) -> None:
+        self.name = name
+        self.kwargs = kwargs
+        self.phases: defaultdict[str, float] = defaultdict(float)
+        self.rows = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.peak_memory = 0
+        self.peak_rss: int | None = None
+        self.server: dict[str, float] = {}
+        self.notes: dict[str, Any] = {}
+        self._stack: list[list[float]] = []  # [start, time spent in nested phases]
+
+    def enter(self: Self) -> None:
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def exit(self: Self, phase: str) -> None:
+        start, nested = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.phases[phase] += elapsed - nested
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def as_dict(self: Self) -> dict[str, Any]:
+        phases = dict(self.phases)
+        phases["other"] = max(0.0, self.seconds - sum(phases.values()))
+        return {
+            "loader": self.name,
+            "kwargs": {key: repr(value) for key, value in self.kwargs.items()},
+            "seconds": self.seconds,
+            "phases": phases,
+            "rows": self.rows,
+            "rows_per_sec": self.rows / self.seconds if self.seconds else 0.0,
+            "bytes_sent": self.bytes_sent,
+            "peak_memory_mb": self.peak_memory / 2**20,
+            "peak_rss_mb": None if self.peak_rss is None else self.peak_rss / 2**20,
+            "server": self.server,
+            "notes": self.notes,
+        }
+
+
+def _status_bytes(field: str) -> int | None:
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> int | None:
+    """Start the peak resident set size (VmHWM) over from now, returns
+    the current one in bytes. None if /proc/self/clear_refs isn't there
+    or can't be written"""
+
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        return None
+    return _status_bytes("VmRSS")
+
+
+def peak_rss() -> int | None:
+    """Peak resident set size in bytes since the last reset_peak_rss"""
+
+    return _status_bytes("VmHWM")
+
+
+_current: ContextVar[RunRecord | None] = ContextVar("_current", default=None)
+
+
+@contextmanager
+def measure(
+    name: str,
+    kwargs: dict[str, Any],
+    server: AbstractContextManager[dict[str, float]] | None = None,
+) -> Iterator[RunRecord]:
+    """Record one run: phases, rows, bytes sent, tracemalloc and rss peaks"""
+
+    record = RunRecord(name, kwargs)
+    with server or nullcontext({}) as costs:
+        token = _current.set(record)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        rss_start = reset_peak_rss()
+        t = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - t
+            record.peak_memory = tracemalloc.get_traced_memory()[1]
+            rss_peak = peak_rss()
+            if rss_start is not None and rss_peak is not None:
+                record.peak_rss = max(0, rss_peak - rss_start)
+            if not tracing:
+                tracemalloc.stop()
+            _current.reset(token)
+    record.server = costs
+
+    result = record.as_dict()
+    RECORDS.append(result)
+    if PROFILE_LOG:
+        with open(PROFILE_LOG, "a") as fp:
+            fp.write(json.dumps(result) + "\n")
+
+
+# --> Helpers for the loaders
+
+def phase(name: str) -> AbstractContextManager[None]:
+    record = _current.get()
+    if record is None:
+        return nullcontext()
+    return _phase(record, name)
+
+
+@contextmanager
+def _phase(record: RunRecord, name: str) -> Iterator[None]:
+    record.enter()
+    try:
+        yield
+    finally:
+        record.exit(name)
+
+
+def add_rows(count: int) -> None:
+    record = _current.get()
+    if record is not None:
+        record.rows += count
+
+
+def note(name: str, value: Any) -> None:
+    """Keep a choice the loader made (a tuned batch size, say) in the record"""
+
+    record = _current.get()
+    if record is not None:
+        record.notes[name] = value
+
+
+_DONE = object()
+
+
+def phased(name: str, iterable: Iterable[Any], count_rows: bool = False) -> Iterable[Any]:
+    """Charge the time spent producing each item to `name`"""
+
+    record = _current.get()
+    if record is None:
+        return iterable
+    return _phased(record, name, iter(iterable), count_rows)
+
+
+def _phased(
+    record: RunRecord, name: str, iterator: Iterator[Any], count_rows: bool
+) -> Iterator[Any]:
+    while True:
+        record.enter()
+        try:
+            item = next(iterator, _DONE)
+        finally:
+            record.exit(name)
+        if item is _DONE:
+            return
+        if count_rows:
+            record.rows += 1
+        yield item
+
+
+class _MeteredWriter(LibpqWriter):
+    def __init__(self: Self, cursor: psycopg.Cursor, record: RunRecord) -> None:
+        super().__init__(cursor)
+        self.record = record
+
+    def write(self: Self, data: Any) -> None:
+        self.record.enter()
+        try:
+            super().write(data)
+        finally:
+            self.record.exit("wire")
+        self.record.bytes_sent += len(data)
+
+    def finish(self: Self, exc: BaseException | None = None) -> None:
+        self.record.enter()
+        try:
+            super().finish(exc)
+        finally:
+            self.record.exit("commit")
+
+
+class _MeteredCopy:
+    """write/write_row time is encode, minus whatever the writer spends on wire"""
+
+    def __init__(self: Self, copy: psycopg.Copy, record: RunRecord) -> None:
+        self._copy = copy
+        self._record = record
+
+    def write(self: Self, buffer: Any) -> None:
+        self._record.enter()
+        try:
+            self._copy.write(buffer)
+        finally:
+            self._record.exit("encode")
+
+    def write_row(self: Self, row: Sequence[Any]) -> None:
+        self._record.enter()
+        try:
+            self._copy.write_row(row)
+        finally:
+            self._record.exit("encode")
+
+    def __getattr__(self: Self, name: str) -> Any:
+        return getattr(self._copy, name)
+
+
+@contextmanager
+def metered_copy(
+    cursor: psycopg.Cursor, statement: str
+) -> Iterator[psycopg.Copy | _MeteredCopy]:
+    """cursor.copy(statement), with encode/wire/commit/bytes accounting
+    when a run is being recorded"""
+
+    record = _current.get()
+    if record is None:
+        with cursor.copy(statement) as copy:
+            yield copy
+        return
+    with cursor.copy(statement, writer=_MeteredWriter(cursor, record)) as copy:
+        yield _MeteredCopy(copy, record)
+
+
+def _byte_length(data: Any) -> int:
+    # StringIO and friends hand psycopg2 str, which goes out as utf-8
+    return len(data.encode()) if isinstance(data, str) else len(data)
+
+
+class _MeteredFile:
+    """For psycopg2's copy_from/copy_expert: the time psycopg2 spends in
+    read() is encode, the rest of the call is wire"""
+
+    def __init__(self: Self, file: Any, record: RunRecord) -> None:
+        self._file = file
+        self._record = record
+
+    def read(self: Self, size: int = -1) -> Any:
+        self._record.enter()
+        try:
+            data = self._file.read(size)
+        finally:
+            self._record.exit("encode")
+        self._record.bytes_sent += _byte_length(data)
+        return data
+
+    def readline(self: Self, size: int = -1) -> Any:
+        self._record.enter()
+        try:
+            data = self._file.readline(size)
+        finally:
+            self._record.exit("encode")
+        self._record.bytes_sent += _byte_length(data)
+        return data
+
+
+def metered_file(file: Any) -> Any:
+    record = _current.get()
+    if record is None:
+        return file
+    return _MeteredFile(file, record)
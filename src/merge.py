@@ -0,0 +1,222 @@
+"""
+Merge stage: staging_beers -> beers
+
+The loaders stop at the UNLOGGED staging table. This moves the staged
+rows into the logged, indexed `beers` table with an upsert, either
+INSERT ... ON CONFLICT or MERGE (postgres 15+). It all happens in one
+transaction, so a failed merge leaves `beers` as it was, dropped
+indexes included.
+
+    load_id = copy_chunked(connection, beers)
+    merge_staging(connection, drop_indexes=True)
+
+Each step is timed as its own phase in the @profile record.
+"""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any, NamedTuple
+
+import psycopg
+from instrument import add_rows, phase
+from psycopg import sql
+from schema import BEERS, STAGING_BEERS, TableSpec
+from typing_extensions import Self
+from utils import profile
+
+# secondary indexes a fresh `beers` table starts with
+BEERS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS beers_name_idx ON beers (name)",
+    "CREATE INDEX IF NOT EXISTS beers_first_brewed_idx ON beers (first_brewed)",
+)
+
+# SET LOCAL for the merge transaction only. synchronous_commit=off can
+# lose the last moments of commits on a crash but never corrupts
+# anything, and a lost merge can just be run again
+SESSION_SETTINGS = {
+    "maintenance_work_mem": "1GB",
+    "work_mem": "256MB",
+    "synchronous_commit": "off",
+}
+
+
+class MergeResult(NamedTuple):
+    staged: int
+    merged: int  # inserted or actually changed
+    steps: dict[str, float]
+
+    @property
+    def seconds(self: Self) -> float:
+        return sum(self.steps.values())
+
+
+def create_target_table(cursor: psycopg.Cursor, target: TableSpec = BEERS) -> None:
+    cursor.execute(target.ddl(replace=False))
+    if target is BEERS:
+        for statement in BEERS_INDEXES:
+            cursor.execute(statement)
+
+
+def secondary_indexes(cursor: psycopg.Cursor, table: str) -> list[tuple[str, str]]:
+    """(name, CREATE INDEX statement) of the indexes that don't back a
+    constraint, those go with their constraint"""
+
+    cursor.execute(
+        """
+        SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid)
+        FROM pg_index
+        JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+        WHERE pg_index.indrelid = %s::regclass
+          AND NOT EXISTS (
+              SELECT 1 FROM pg_constraint WHERE conindid = pg_index.indexrelid
+          )
+        ORDER BY 1""",
+        (table,),
+    )
+    return cursor.fetchall()
+
+
+def droppable_constraints(cursor: psycopg.Cursor, table: str) -> list[tuple[str, str]]:
+    """(name, definition) of check, unique, foreign key and exclusion
+    constraints. The primary key stays, the upsert needs it"""
+
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('c', 'f', 'u', 'x')
+        ORDER BY 1""",
+        (table,),
+    )
+    return cursor.fetchall()
+
+
+def upsert_statement(target: TableSpec, staging: TableSpec) -> str:
+    """INSERT ... SELECT ... ON CONFLICT DO UPDATE
+
+    staging_beers can hold the same id more than once, and one statement
+    can't update a row twice, so only the most recently loaded copy of
+    each key is kept (highest ctid, which is load order for a freshly
+    filled heap). Rows that didn't change aren't rewritten.
+    """
+
+    keys = ", ".join(target.primary_key)
+    columns = ", ".join(target.names)
+    others = [name for name in target.names if name not in target.primary_key]
+    return f"""
+        INSERT INTO {target.table} ({columns})
+        SELECT DISTINCT ON ({keys}) {columns}
+        FROM {staging.table}
+        ORDER BY {keys}, ctid DESC
+        ON CONFLICT ({keys}) DO UPDATE SET
+            {", ".join(f"{name} = EXCLUDED.{name}" for name in others)}
+        WHERE ({", ".join(f"{target.table}.{name}" for name in others)})
+            IS DISTINCT FROM ({", ".join(f"EXCLUDED.{name}" for name in others)})"""
+
+
+def merge_statement(target: TableSpec, staging: TableSpec) -> str:
+    """The same upsert as upsert_statement, written as MERGE"""
+
+    keys = ", ".join(target.primary_key)
+    columns = ", ".join(target.names)
+    others = [name for name in target.names if name not in target.primary_key]
+    return f"""
+        MERGE INTO {target.table} AS target
+        USING (
+            SELECT DISTINCT ON ({keys}) {columns}
+            FROM {staging.table}
+            ORDER BY {keys}, ctid DESC
+        ) AS source
+        ON {" AND ".join(f"target.{key} = source.{key}" for key in target.primary_key)}
+        WHEN MATCHED AND ({", ".join(f"target.{name}" for name in others)})
+            IS DISTINCT FROM ({", ".join(f"source.{name}" for name in others)}) THEN
+            UPDATE SET {", ".join(f"{name} = source.{name}" for name in others)}
+        WHEN NOT MATCHED THEN
+            INSERT ({columns}) VALUES ({", ".join(f"source.{name}" for name in target.names)})"""
+
+
+@contextmanager
+def _step(steps: dict[str, float], name: str) -> Iterator[None]:
+    with phase(name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            steps[name] = time.perf_counter() - t
+
+
+@profile
+def merge_staging(
+    connection: psycopg.Connection,
+    target: TableSpec = BEERS,
+    staging: TableSpec = STAGING_BEERS,
+    use_merge: bool = False,
+    drop_indexes: bool = False,
+    settings: dict[str, Any] | None = None,
+    analyze: bool = True,
+) -> MergeResult:
+    """Upsert everything in staging into target, in one transaction
+
+    drop_indexes=True drops the secondary indexes and the non-primary-key
+    constraints first and builds them again afterwards. One index build
+    is a lot cheaper than updating the index for every row once a merge
+    touches a good part of the table, but the indexes are gone for the
+    duration. settings are SET LOCAL on top of SESSION_SETTINGS.
+    """
+
+    steps: dict[str, float] = {}
+    # the commit phase ends up as whatever the steps don't cover, mostly
+    # the COMMIT itself, which is where the WAL flush shows up
+    with phase("commit"), connection.transaction(), connection.cursor() as cursor:
+        with _step(steps, "settings"):
+            for name, value in {**SESSION_SETTINGS, **(settings or {})}.items():
+                cursor.execute(
+                    sql.SQL("SET LOCAL {} = {}").format(
+                        sql.Identifier(name), sql.Literal(str(value))
+                    )
+                )
+            create_target_table(cursor, target)
+            cursor.execute(f"SELECT count(*) FROM {staging.table}")
+            (staged,) = cursor.fetchone()
+
+        indexes: list[tuple[str, str]] = []
+        constraints: list[tuple[str, str]] = []
+        if drop_indexes:
+            with _step(steps, "drop_indexes"):
+                indexes = secondary_indexes(cursor, target.table)
+                constraints = droppable_constraints(cursor, target.table)
+                for name, _ in constraints:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                            sql.Identifier(target.table), sql.Identifier(name)
+                        )
+                    )
+                for name, _ in indexes:
+                    cursor.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(name)))
+
+        with _step(steps, "merge"):
+            statement = merge_statement if use_merge else upsert_statement
+            cursor.execute(statement(target, staging))
+            merged = cursor.rowcount
+            add_rows(merged)
+
+        if drop_indexes:
+            with _step(steps, "rebuild_indexes"):
+                for _, definition in indexes:
+                    cursor.execute(definition)
+                for name, definition in constraints:
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(
+                            sql.Identifier(target.table), sql.Identifier(name)
+                        )
+                        + sql.SQL(definition)
+                    )
+
+        if analyze:
+            with _step(steps, "analyze"):
+                cursor.execute(f"ANALYZE {target.table}")
+        t = time.perf_counter()
+    steps["commit"] = time.perf_counter() - t
+
+    return MergeResult(staged, merged, steps)
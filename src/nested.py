@@ -0,0 +1,289 @@
+"""
+The nested parts of the api records, as their own tables, in one pass
+
+staging_beers keeps only the flat fields (and volume.value). The malts,
+hops, mash temperatures and food pairings are lists inside each record:
+
+    nested_beers                  one row per record, plus yeast, twist, ...
+    nested_beer_malts             (beer_key, position) -> name, amount, unit
+    nested_beer_hops              ... plus when it's added and what for
+    nested_beer_mash_temps
+    nested_beer_food_pairings
+
+copy_nested walks the records once and hands each table's rows to its
+own COPY stream, each with its own queue, thread and connection. The
+foreign key is a beer_key counted up on the client, so no row has to
+wait for the server to hand out an id (an api id isn't unique once
+get_beers has repeated the data). Keys and foreign keys are added after
+the data is in, each stream builds its primary key as soon as its COPY
+is done.
+"""
+
+import queue
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import suppress
+from typing import Any, NamedTuple
+
+import psycopg
+from instrument import phase, phased
+from parallel_encode import CopyEncoder
+from schema import STAGING_BEERS, Column, TableSpec
+from utils import profile
+
+
+# sent down the queues when the load has failed
+_ABORT: Any = object()
+
+
+class NestedTable(NamedTuple):
+    spec: TableSpec
+    path: str | None  # dotted path to the list in the api record, None for the beer
+    extract: Callable[[Any], tuple]  # list item (or record) -> the non-key columns
+
+
+def nested_table(
+    table: str,
+    path: str | None,
+    columns: Iterable[Column],
+    extract: Callable[[Any], tuple] | None = None,
+) -> NestedTable:
+    """Keyed on beer_key, and position in the list for a list. extract
+    defaults to the columns' paths into each item"""
+
+    columns = list(columns)
+    keys = [Column("beer_key", "bigint")]
+    if path is not None:
+        keys.append(Column("position", "integer"))
+    return NestedTable(
+        TableSpec(table, [*keys, *columns], primary_key=[key.name for key in keys]),
+        path,
+        extract or TableSpec(table, columns).extract,
+    )
+
+
+NESTED_BEERS = nested_table(
+    "nested_beers",
+    None,
+    [
+        *STAGING_BEERS.columns,
+        Column("boil_volume", "integer", path="boil_volume.value"),
+        Column("yeast", "text", path="ingredients.yeast"),
+        Column("fermentation_temp", "numeric", path="method.fermentation.temp.value"),
+        Column("twist", "text", path="method.twist"),
+    ],
+)
+
+# the beer first, everything else references it
+NESTED_TABLES = (
+    NESTED_BEERS,
+    nested_table(
+        "nested_beer_malts",
+        "ingredients.malt",
+        [
+            Column("name", "text"),
+            Column("amount", "numeric", path="amount.value"),
+            Column("unit", "text", path="amount.unit"),
+        ],
+    ),
+    nested_table(
+        "nested_beer_hops",
+        "ingredients.hops",
+        [
+            Column("name", "text"),
+            Column("amount", "numeric", path="amount.value"),
+            Column("unit", "text", path="amount.unit"),
+            Column("addition", "text", path="add"),
+            Column("attribute", "text"),
+        ],
+    ),
+    nested_table(
+        "nested_beer_mash_temps",
+        "method.mash_temp",
+        [
+            Column("temp", "numeric", path="temp.value"),
+            Column("unit", "text", path="temp.unit"),
+            Column("duration", "numeric"),
+        ],
+    ),
+    nested_table(
+        "nested_beer_food_pairings",
+        "food_pairing",
+        [Column("food", "text")],
+        extract=lambda food: (food,),
+    ),
+)
+
+
+def create_nested_tables(cursor: Any, tables: tuple[NestedTable, ...] = NESTED_TABLES) -> None:
+    """Drop and recreate, without keys, those come after the load"""
+
+    names = ", ".join(table.spec.table for table in tables)
+    cursor.execute(f"DROP TABLE IF EXISTS {names}")
+    for table in tables:
+        cursor.execute(TableSpec(table.spec.table, table.spec.columns).ddl(replace=False))
+
+
+def _list_at(record: dict[str, Any], path: str) -> list[Any]:
+    for key in path.split("."):
+        record = record.get(key) or {}
+    return record or []
+
+
+def iter_nested_rows(
+    beers: Iterable[dict[str, Any]], tables: tuple[NestedTable, ...] = NESTED_TABLES
+) -> Iterator[list[list[tuple]]]:
+    """Each record as its rows for every table, beer_key counting from 1"""
+
+    for beer_key, beer in enumerate(beers, 1):
+        rows = []
+        for table in tables:
+            if table.path is None:
+                rows.append([(beer_key, *table.extract(beer))])
+            else:
+                rows.append(
+                    [
+                        (beer_key, position, *table.extract(item))
+                        for position, item in enumerate(_list_at(beer, table.path))
+                    ]
+                )
+        yield rows
+
+
+def _chunks_until_done(chunks: queue.Queue) -> Iterator[list[tuple]]:
+    while (chunk := chunks.get()) is not None:
+        if chunk is _ABORT:
+            # raising inside the copy block aborts the COPY
+            msg = "Aborted, the load failed elsewhere"
+            raise RuntimeError(msg)
+        yield chunk
+
+
+def _copy_stream(
+    connection: psycopg.Connection, spec: TableSpec, chunks: queue.Queue, keys: bool
+) -> int:
+    """COPY the chunks that come down the queue, then add the primary key"""
+
+    encoder = CopyEncoder(spec, numeric_from_float=True)
+    rows = 0
+    with connection.cursor() as cursor:
+        with cursor.copy(spec.copy_statement()) as copy:
+            for chunk in _chunks_until_done(chunks):
+                copy.write(encoder.encode(chunk))
+                rows += len(chunk)
+        if keys:
+            cursor.execute(
+                f"ALTER TABLE {spec.table} ADD PRIMARY KEY ({', '.join(spec.primary_key)})"
+            )
+    return rows
+
+
+def _put(chunks: queue.Queue, item: Any, stream: Future) -> None:
+    """Queue item for a stream, or raise what the stream raised if it has
+    stopped, instead of waiting on its full queue forever"""
+
+    while True:
+        if stream.done():
+            stream.result()
+            msg = "A COPY stream stopped before the end of the data"
+            raise RuntimeError(msg)
+        with suppress(queue.Full):
+            chunks.put(item, timeout=0.1)
+            return
+
+
+def _feed(
+    beers: Iterable[dict[str, Any]],
+    tables: tuple[NestedTable, ...],
+    queues: list[queue.Queue],
+    streams: list[Future],
+    chunk_records: int,
+) -> None:
+    pending: list[list[tuple]] = [[] for _ in tables]
+    for count, rows in enumerate(iter_nested_rows(beers, tables), 1):
+        for table_rows, new_rows in zip(pending, rows):
+            table_rows += new_rows
+        if count % chunk_records == 0:
+            # waiting on a full queue means that stream is behind
+            with phase("wire"):
+                for chunks, table_rows, stream in zip(queues, pending, streams):
+                    _put(chunks, table_rows, stream)
+            pending = [[] for _ in tables]
+    with phase("wire"):
+        for chunks, table_rows, stream in zip(queues, pending, streams):
+            _put(chunks, table_rows, stream)
+            _put(chunks, None, stream)
+
+
+# --> Loaders
+
+@profile
+def copy_nested(
+    connection: psycopg.Connection,
+    beers: list[dict[str, Any]],
+    chunk_records: int = 1000,
+    queue_depth: int = 4,
+    keys: bool = True,
+    open_connection: Callable[[], psycopg.Connection] | None = None,
+) -> dict[str, int]:
+    """Every nested table in one walk over beers, a concurrent COPY per table
+
+    Rows are handed to the streams chunk_records records at a time, and a
+    stream that's queue_depth chunks behind holds up the walk. The beers
+    stream uses connection, the others get one from open_connection, by
+    default a new connection to the same database (the password comes
+    from the environment or .pgpass). keys=False leaves out the primary
+    and foreign keys. Returns the rows loaded per table.
+    """
+
+    tables = NESTED_TABLES
+    with connection.cursor() as cursor:
+        create_nested_tables(cursor, tables)
+
+    if open_connection is None:
+        dsn = connection.info.dsn
+
+        def open_connection() -> psycopg.Connection:
+            return psycopg.connect(dsn, autocommit=True)
+
+    connections = [connection]
+    queues: list[queue.Queue] = [queue.Queue(maxsize=queue_depth) for _ in tables]
+    try:
+        connections += [open_connection() for _ in tables[1:]]
+        with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+            futures = [
+                pool.submit(_copy_stream, stream, table.spec, chunks, keys)
+                for stream, table, chunks in zip(connections, tables, queues)
+            ]
+            try:
+                records = phased("transform", beers, count_rows=True)
+                _feed(records, tables, queues, futures, chunk_records)
+            except BaseException:
+                # abort the other COPYs too
+                for chunks, stream in zip(queues, futures):
+                    with suppress(Exception):
+                        _put(chunks, _ABORT, stream)
+                raise
+            with phase("commit"):
+                loaded = [future.result() for future in futures]
+    finally:
+        for stream in connections[1:]:
+            stream.close()
+
+    if keys:
+        with phase("keys"), connection.cursor() as cursor:
+            for table in tables[1:]:
+                cursor.execute(
+                    f"ALTER TABLE {table.spec.table} ADD FOREIGN KEY (beer_key) "
+                    f"REFERENCES {NESTED_BEERS.spec.table} (beer_key)"
+                )
+
+    return {table.spec.table: rows for table, rows in zip(tables, loaded)}
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_nested": [
+        {"keys": False},
+    ],
+}
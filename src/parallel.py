@@ -0,0 +1,141 @@
+"""
+One backend process is the ceiling for a single COPY, so split the rows
+into shards and run a COPY per shard, each on its own connection (and
+optionally in its own python process so the row encoding is parallel too)
+"""
+
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import pairwise
+from typing import Any, NamedTuple
+
+import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows
+from schema import STAGING_BEERS
+from typing_extensions import Self
+from utils import (
+    TEXT_COPY_OPTIONS,
+    BytesIteratorIO,
+    EitherConnection,
+    clean_csv_value,
+    create_staging_table,
+    profile,
+)
+
+
+class ShardResult(NamedTuple):
+    shard: int
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_sec(self: Self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class ParallelResult(NamedTuple):
+    shards: list[ShardResult]
+    rows: int
+    seconds: float  # wall clock, all shards
+
+    @property
+    def rows_per_sec(self: Self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def split_shards(
+    beers: Sequence[dict[str, Any]], shards: int
+) -> list[Sequence[dict[str, Any]]]:
+    """Contiguous, nearly equal-sized slices of the input"""
+
+    size, extra = divmod(len(beers), shards)
+    bounds = [0]
+    for shard in range(shards):
+        bounds.append(bounds[-1] + size + (shard < extra))
+    return [beers[start:stop] for start, stop in pairwise(bounds)]
+
+
+def _copy_psycopg(connection: psycopg.Connection, beers: Sequence[dict[str, Any]]) -> None:
+    with connection.cursor() as cursor:
+        register_float_numeric_dumpers(cursor)
+        with cursor.copy(STAGING_BEERS.copy_statement()) as copy:
+            copy.set_types(STAGING_BEERS.types)
+            for beer in beers:
+                copy.write_row(STAGING_BEERS.extract(beer))
+
+
+def _copy_psycopg2(connection: EitherConnection, beers: Sequence[dict[str, Any]]) -> None:
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            STAGING_BEERS.copy_statement(TEXT_COPY_OPTIONS),
+            BytesIteratorIO(
+                ("|".join(map(clean_csv_value, STAGING_BEERS.extract(beer))) + "\n").encode()
+                for beer in beers
+            ),
+            size=2**16,
+        )
+
+
+def copy_shard(
+    open_connection: Callable[[], EitherConnection],
+    shard: int,
+    beers: Sequence[dict[str, Any]],
+) -> ShardResult:
+    """COPY one shard on a fresh connection. Module level so a process pool
+    can pickle it along with the open_connection function"""
+
+    connection = open_connection()
+    try:
+        t = time.perf_counter()
+        if isinstance(connection, psycopg.Connection):
+            _copy_psycopg(connection, beers)
+        else:
+            _copy_psycopg2(connection, beers)
+        return ShardResult(shard, len(beers), time.perf_counter() - t)
+    finally:
+        connection.close()
+
+
+@profile
+def copy_parallel(
+    open_connection: Callable[[], EitherConnection],
+    beers: Sequence[dict[str, Any]],
+    shards: int = 4,
+    processes: bool = False,
+) -> ParallelResult:
+    """Run `shards` concurrent COPY streams into staging_beers
+
+    open_connection is the one from psycopg_implementation or
+    psycopg2_implementation and picks the driver. With processes=True
+    each shard is encoded in its own process instead of a thread.
+    Returns every shard's rows and time, and the totals.
+    """
+
+    connection = open_connection()
+    try:
+        with connection.cursor() as cursor:
+            create_staging_table(cursor)
+    finally:
+        connection.close()
+
+    pool: Executor = (
+        ProcessPoolExecutor(max_workers=shards)
+        if processes
+        else ThreadPoolExecutor(max_workers=shards)
+    )
+    t = time.perf_counter()
+    with pool:
+        futures = [
+            pool.submit(copy_shard, open_connection, shard, rows)
+            for shard, rows in enumerate(split_shards(beers, shards))
+        ]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            # the shards run in other threads or processes, outside the record
+            add_rows(results[-1].rows)
+    elapsed = time.perf_counter() - t
+
+    return ParallelResult(results, sum(result.rows for result in results), elapsed)
@@ -0,0 +1,211 @@
+"""
+One COPY stream, with the row encoding spread over a process pool
+
+In copy_tuple_iterator the same core that drives the socket also turns
+every value into COPY bytes, so a single connection tops out at what one
+python thread can encode. Here worker processes encode chunks of rows
+into ready-to-send COPY data (text or binary) and leave it in shared
+memory. All the parent does is copy.write() each buffer, in order.
+
+The workers get the rows once, when the pool starts, and only
+(start, stop, slot) goes back and forth per chunk, so nothing is
+pickled per row. There are 2 slots per worker: while the parent sends
+one chunk the workers are already filling the next ones.
+"""
+
+import re
+import struct
+from collections import deque
+from collections.abc import Iterable, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any
+
+import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, metered_copy, phase
+from psycopg import pq
+from psycopg.adapt import AdaptersMap, PyFormat, Transformer
+from schema import STAGING_BEERS, TableSpec
+from typing_extensions import Self
+from utils import create_staging_table, profile
+
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = b"\xff\xff"
+_NULL = struct.pack("!i", -1)
+
+# the same escaping psycopg applies in text COPY
+_ESCAPE_RE = re.compile(b"[\b\t\n\v\f\r\\\\]")
+_ESCAPES = {
+    b"\b": b"\\b",
+    b"\t": b"\\t",
+    b"\n": b"\\n",
+    b"\v": b"\\v",
+    b"\f": b"\\f",
+    b"\r": b"\\r",
+    b"\\": b"\\\\",
+}
+
+
+def _escape(match: re.Match[bytes]) -> bytes:
+    return _ESCAPES[match.group(0)]
+
+
+class CopyEncoder:
+    """Rows of a TableSpec to COPY bytes, the same bytes copy.write_row
+    would send, but without needing a connection"""
+
+    def __init__(
+        self: Self,
+        spec: TableSpec = STAGING_BEERS,
+        binary: bool = False,
+        numeric_from_float: bool = True,
+    ) -> None:
+        self.spec = spec
+        self.binary = binary
+        adapters = AdaptersMap(psycopg.adapters)
+        if numeric_from_float:
+            register_float_numeric_dumpers(adapters)
+        self._transformer = Transformer(adapters)
+        self._transformer.set_dumper_types(
+            spec.oids, pq.Format.BINARY if binary else pq.Format.TEXT
+        )
+        self._formats = [PyFormat.BINARY if binary else PyFormat.TEXT] * len(spec.columns)
+        # numbers and dates never need escaping, only text does
+        self._escape = [type_name == "text" for type_name in spec.types]
+
+    @property
+    def header(self: Self) -> bytes:
+        return BINARY_HEADER if self.binary else b""
+
+    @property
+    def trailer(self: Self) -> bytes:
+        return BINARY_TRAILER if self.binary else b""
+
+    def encode(self: Self, rows: Iterable[Sequence[Any]]) -> bytearray:
+        dump = self._transformer.dump_sequence
+        formats = self._formats
+        out = bytearray()
+        if self.binary:
+            count = struct.pack("!h", len(self.spec.columns))
+            pack_length = struct.Struct("!i").pack
+            for row in rows:
+                out += count
+                for value in dump(row, formats):
+                    if value is None:
+                        out += _NULL
+                    else:
+                        out += pack_length(len(value))
+                        out += value
+        else:
+            escape = self._escape
+            for row in rows:
+                out += b"\t".join(
+                    [
+                        rb"\N"
+                        if value is None
+                        else _ESCAPE_RE.sub(_escape, value) if text else value
+                        for value, text in zip(dump(row, formats), escape)
+                    ]
+                )
+                out += b"\n"
+        return out
+
+
+# --> Worker process side, set up once per process by the pool initializer
+
+_worker: dict[str, Any] = {}
+
+
+def _init_worker(
+    beers: Sequence[dict[str, Any]],
+    binary: bool,
+    numeric_from_float: bool,
+    slot_names: Sequence[str],
+) -> None:
+    _worker["beers"] = beers
+    _worker["encoder"] = CopyEncoder(STAGING_BEERS, binary, numeric_from_float)
+    _worker["slots"] = [SharedMemory(name) for name in slot_names]
+
+
+def _encode_chunk(start: int, stop: int, slot: int) -> tuple[int, bytes | None]:
+    """Encode beers[start:stop] into a slot, returns the length. Data too
+    big for the slot comes back through the pipe instead"""
+
+    rows = map(STAGING_BEERS.extract, _worker["beers"][start:stop])
+    data = _worker["encoder"].encode(rows)
+    buffer = _worker["slots"][slot].buf
+    if len(data) > len(buffer):
+        return len(data), bytes(data)
+    buffer[: len(data)] = data
+    return len(data), None
+
+
+# --> Parent side
+
+@profile
+def copy_encoded_in_pool(
+    connection: psycopg.Connection,
+    beers: Sequence[dict[str, Any]],
+    workers: int = 4,
+    chunk_rows: int = 5_000,
+    slot_bytes: int = 8 * 2**20,
+    binary: bool = False,
+    numeric_from_float: bool = True,
+) -> None:
+    """COPY beers over one connection, encoded by `workers` processes
+
+    chunk_rows rows are encoded per task. slot_bytes should fit a chunk's
+    worth of COPY data, bigger chunks still work but go through the pipe.
+    """
+
+    slots = [SharedMemory(create=True, size=slot_bytes) for _ in range(2 * workers)]
+    try:
+        create_staging_table(connection)
+        with (
+            ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(beers, binary, numeric_from_float, [slot.name for slot in slots]),
+            ) as pool,
+            connection.cursor() as cursor,
+            metered_copy(
+                cursor, STAGING_BEERS.copy_statement("FORMAT BINARY" if binary else "")
+            ) as copy,
+        ):
+            free = deque(range(len(slots)))
+            pending: deque[tuple[Future, int, int]] = deque()
+
+            def send_oldest() -> None:
+                future, slot, rows = pending.popleft()
+                with phase("encode"):
+                    # waiting on a worker is the encode we couldn't overlap
+                    size, data = future.result()
+                copy.write(slots[slot].buf[:size] if data is None else data)
+                add_rows(rows)
+                free.append(slot)
+
+            if binary:
+                copy.write(BINARY_HEADER)
+            for start in range(0, len(beers), chunk_rows):
+                if not free:
+                    send_oldest()
+                stop = min(start + chunk_rows, len(beers))
+                slot = free.popleft()
+                pending.append((pool.submit(_encode_chunk, start, stop, slot), slot, stop - start))
+            while pending:
+                send_oldest()
+            if binary:
+                copy.write(BINARY_TRAILER)
+    finally:
+        for slot in slots:
+            slot.close()
+            slot.unlink()
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_encoded_in_pool": [
+        {"binary": True},
+    ],
+}
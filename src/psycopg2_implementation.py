@@ -9,8 +9,16 @@ from collections.abc import Iterator
 from typing import Any
 
 import psycopg2
+from instrument import metered_file, phase, phased
+from schema import STAGING_BEERS
 from typing_extensions import Self
-from utils import clean_csv_value, create_staging_table, parse_first_brewed, profile
+from utils import (
+    TEXT_COPY_OPTIONS,
+    BytesIteratorIO,
+    clean_csv_value,
+    create_staging_table,
+    profile,
+)
 
 """
 
@@ -35,38 +43,18 @@ def copy_stringio(connection: psycopg2.extensions.connection, beers: list[dict[s
     with connection.cursor() as cursor:
         create_staging_table(cursor)
         csv_file_like_object = io.StringIO()
-        for beer in beers:
-            csv_file_like_object.write(
-                 "|".join(
-                        map(
-                            clean_csv_value,
-                            (
-                                beer["id"],
-                                beer["name"],
-                                beer["tagline"],
-                                parse_first_brewed(beer["first_brewed"]).isoformat(),
-                                beer["description"],
-                                beer["image_url"],
-                                beer["abv"],
-                                beer["ibu"],
-                                beer["target_fg"],
-                                beer["target_og"],
-                                beer["ebc"],
-                                beer["srm"],
-                                beer["ph"],
-                                beer["attenuation_level"],
-                                beer["contributed_by"],
-                                beer["brewers_tips"],
-                                beer["volume"]["value"],
-                            ), # end tuple
-                        )  # end map
-                    )  # end join |
-                + "\n"
-            )  # end write
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        with phase("encode"):
+            for row in rows:
+                csv_file_like_object.write("|".join(map(clean_csv_value, row)) + "\n")
 
         csv_file_like_object.seek(0)
-        cursor.copy_from(
-                csv_file_like_object, 'staging_beers', sep='|'
+        with phase("wire"):
+            cursor.copy_from(
+                metered_file(csv_file_like_object),
+                STAGING_BEERS.table,
+                sep='|',
+                columns=STAGING_BEERS.names,
             )
 
 
@@ -112,26 +100,47 @@ def copy_string_iterator(
 ) -> None:
     with connection.cursor() as cursor:
         create_staging_table(cursor)
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
         beers_string_iterator = StringIteratorIO(
-            '|'.join(map(clean_csv_value, (
-                beer['id'],
-                beer['name'],
-                beer['tagline'],
-                parse_first_brewed(beer['first_brewed']).isoformat(),
-                beer['description'],
-                beer['image_url'],
-                beer['abv'],
-                beer['ibu'],
-                beer['target_fg'],
-                beer['target_og'],
-                beer['ebc'],
-                beer['srm'],
-                beer['ph'],
-                beer['attenuation_level'],
-                beer['brewers_tips'],
-                beer['contributed_by'],
-                beer['volume']['value'],
-            ))) + '\n'
-            for beer in beers
+            '|'.join(map(clean_csv_value, row)) + '\n' for row in rows
         )
-        cursor.copy_from(beers_string_iterator, 'staging_beers', sep='|')
+        # psycopg2 pulls the rows through read(), which metered_file
+        # charges to encode, the rest of copy_from is wire
+        with phase("wire"):
+            cursor.copy_from(
+                metered_file(beers_string_iterator),
+                STAGING_BEERS.table,
+                sep='|',
+                columns=STAGING_BEERS.names,
+            )
+
+
+@profile
+def copy_bytes_iterator(
+    connection: psycopg2.extensions.connection,
+    beers: list[dict[str, Any]],
+    buffer_size: int = 2**16,
+) -> None:
+    """copy_string_iterator with bytes lines and BytesIteratorIO: psycopg2
+    reads buffer_size bytes at a time and has nothing left to encode"""
+
+    with connection.cursor() as cursor:
+        create_staging_table(cursor)
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        lines = (
+            ("|".join(map(clean_csv_value, row)) + "\n").encode() for row in rows
+        )
+        with phase("wire"):
+            cursor.copy_expert(
+                STAGING_BEERS.copy_statement(TEXT_COPY_OPTIONS),
+                metered_file(BytesIteratorIO(lines)),
+                size=buffer_size,
+            )
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "insert_multirow": [
+        {"prepare": False},
+    ],
+}
@@ -4,10 +4,20 @@ but with newer psycopg3
 """
 
 import io
+from contextlib import nullcontext
 from typing import Any
 
 import psycopg
-from utils import clean_csv_value, create_staging_table, parse_first_brewed, profile
+from float_numeric import register_float_numeric_dumpers
+from instrument import metered_copy, note, phase, phased
+from schema import STAGING_BEERS, TableSpec
+from utils import (
+    TEXT_COPY_OPTIONS,
+    clean_csv_value,
+    create_staging_table,
+    iter_coalesced,
+    profile,
+)
 
 """
 
@@ -33,47 +43,13 @@ def copy_stringio(connection: psycopg.Connection, beers: list[dict[str, Any]]) -
         create_staging_table(cursor)
 
         csv_file_like_object = io.StringIO()
-        for beer in beers:
-            csv_file_like_object.write(
-                 "|".join(
-                        map(
-                            clean_csv_value,
-                            (
-                                beer["id"],
-                                beer["name"],
-                                beer["tagline"],
-                                parse_first_brewed(beer["first_brewed"]).isoformat(),
-                                beer["description"],
-                                beer["image_url"],
-                                beer["abv"],
-                                beer["ibu"],
-                                beer["target_fg"],
-                                beer["target_og"],
-                                beer["ebc"],
-                                beer["srm"],
-                                beer["ph"],
-                                beer["attenuation_level"],
-                                beer["contributed_by"],
-                                beer["brewers_tips"],
-                                beer["volume"]["value"],
-                            ), # end tuple
-                        )  # end map
-                    )  # end join |
-                    + "\n"
-            )  # end write
-
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        with phase("encode"):
+            for row in rows:
+                csv_file_like_object.write("|".join(map(clean_csv_value, row)) + "\n")
 
         csv_file_like_object.seek(0)
-        with cursor.copy(
-            """COPY
-            staging_beers
-            FROM STDIN (
-                FORMAT CSV,
-                HEADER FALSE,
-                DELIMITER '|',
-                NULL '\\N'
-            )""",
-        ) as copy:
+        with metered_copy(cursor, STAGING_BEERS.copy_statement(TEXT_COPY_OPTIONS)) as copy:
             copy.write(csv_file_like_object.getvalue())
 
 
@@ -89,120 +65,138 @@ def copy_string_iterator(
     with connection.cursor() as cursor:
         create_staging_table(cursor)
 
-        with cursor.copy(
-            """COPY
-            staging_beers FROM STDIN (
-                FORMAT CSV,
-                HEADER FALSE,
-                DELIMITER '|',
-                NULL '\\N'
-            )""",
-        ) as copy:
-            for beer in beers:
-                copy.write(
-                    "|".join(
-                        map(
-                            clean_csv_value,
-                            (
-                                beer["id"],
-                                beer["name"],
-                                beer["tagline"],
-                                parse_first_brewed(beer["first_brewed"]).isoformat(),
-                                beer["description"],
-                                beer["image_url"],
-                                beer["abv"],
-                                beer["ibu"],
-                                beer["target_fg"],
-                                beer["target_og"],
-                                beer["ebc"],
-                                beer["srm"],
-                                beer["ph"],
-                                beer["attenuation_level"],
-                                beer["contributed_by"],
-                                beer["brewers_tips"],
-                                beer["volume"]["value"],
-                            ),
-                        )  # end map
-                    )  # end join |
-                )  # end write
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        lines = phased("encode", ("|".join(map(clean_csv_value, row)) for row in rows))
+        with metered_copy(cursor, STAGING_BEERS.copy_statement(TEXT_COPY_OPTIONS)) as copy:
+            for line in lines:
+                copy.write(line)
                 copy.write("\n")
 
 
+@profile
+def copy_bytes_iterator(
+    connection: psycopg.Connection,
+    beers: list[dict[str, Any]],
+    buffer_size: int = 2**16,
+) -> None:
+    """copy_string_iterator, but the lines are bytes and get packed into
+    buffer_size writes, instead of two copy.write calls per row"""
+
+    with connection.cursor() as cursor:
+        create_staging_table(cursor)
+
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        lines = phased(
+            "encode",
+            (("|".join(map(clean_csv_value, row)) + "\n").encode() for row in rows),
+        )
+        with metered_copy(cursor, STAGING_BEERS.copy_statement(TEXT_COPY_OPTIONS)) as copy:
+            for buffer in iter_coalesced(lines, buffer_size):
+                copy.write(buffer)
+
+
 @profile
 def copy_tuple_iterator(
     connection: psycopg.Connection,
     beers: list[dict[str, Any]],
+    binary: bool = False,
+    numeric_from_float: bool = True,
 ) -> None:
     """Neither of the above methods is actually the best way to use modern psycopg:
     Let psycopg handle any nulls and deciding whether to send the value as a string
     or as a binary
+
+    binary=True uses COPY (FORMAT BINARY), so the server doesn't have to parse
+    any text. numeric_from_float registers float_numeric's dumpers, psycopg's
+    own can't dump the api's floats into the numeric columns at all.
     """
     with connection.cursor() as cursor:
+        if numeric_from_float:
+            register_float_numeric_dumpers(cursor)
         create_staging_table(cursor)
 
-        with cursor.copy(
-            """COPY staging_beers(
-                  id,                  -- 1
-                  name,                -- 2
-                  tagline,             -- 3
-                  first_brewed,        -- 4
-                  description,         -- 5
-                  image_url,           -- 6
-                  abv,                 -- 7
-                  ibu,                 -- 8
-                  target_fg,           -- 9
-                  target_og,           -- 10
-                  ebc,                 -- 11
-                  srm,                 -- 12
-                  ph,                  -- 13
-                  attenuation_level,   -- 14
-                  contributed_by,      -- 15
-                  brewers_tips,        -- 16
-                  volume               -- 17
-            ) FROM STDIN""",
+        with metered_copy(
+            cursor, STAGING_BEERS.copy_statement("FORMAT BINARY" if binary else "")
         ) as copy:
-            copy.set_types(
-                (
-                    "integer",  # 1
-                    "text",  # 2
-                    "text",  # 3
-                    "date",  # 4
-                    "text",  # 5
-                    "text",  # 6
-                    "numeric",  # 7
-                    "numeric",  # 8
-                    "numeric",  # 9
-                    "numeric",  # 10
-                    "numeric",  # 11
-                    "numeric",  # 12
-                    "numeric",  # 13
-                    "numeric",  # 14
-                    "text",  # 15
-                    "text",  # 16
-                    "integer",  # 17
-                )
-            )
-            for beer in beers:
-                copy.write_row(
-                    (
-                        beer["id"],  # 1
-                        beer["name"],  # 2
-                        beer["tagline"],  # 3
-                        parse_first_brewed(beer["first_brewed"]),  # 4
-                        beer["description"],  # 5
-                        beer["image_url"],  # 6
-                        beer["abv"],  # 7
-                        beer["ibu"],  # 8
-                        beer["target_fg"],  # 9
-                        beer["target_og"],  # 10
-                        beer["ebc"],  # 11
-                        beer["srm"],  # 12
-                        beer["ph"],  # 13
-                        beer["attenuation_level"],  # 14
-                        beer["contributed_by"],  # 15
-                        beer["brewers_tips"],  # 16
-                        beer["volume"]["value"],  # 17
-                    ),
-                )
+            copy.set_types(STAGING_BEERS.types)
+            rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+            for row in rows:
+                copy.write_row(row)
 
 
+@profile
+def copy_freeze(
+    connection: psycopg.Connection,
+    beers: list[dict[str, Any]],
+    freeze: bool = True,
+    logged: bool = False,
+    truncate: bool = False,
+    numeric_from_float: bool = True,
+    first_select: bool = False,
+    vacuum: bool = False,
+) -> None:
+    """Create (or truncate) the table and COPY ... (FREEZE) in one transaction
+
+    A table created or truncated in the same transaction as the COPY
+    can't be seen by anybody else yet, so postgres writes the rows
+    already frozen: the first SELECT doesn't have to set hint bits and
+    dirty every page, and VACUUM has nothing to freeze later.
+    logged=True makes it a regular table, with wal_level=minimal that
+    also skips writing the rows to the WAL (the record notes wal_level). truncate=True empties the
+    existing table instead of dropping it, which keeps it logged or
+    unlogged as it was.
+
+    freeze=False is the usual path for comparison: DDL and COPY as two
+    autocommit statements. first_select and vacuum time a
+    count(*) and a VACUUM after the load.
+    """
+
+    table = TableSpec(STAGING_BEERS.table, STAGING_BEERS.columns, unlogged=not logged)
+    with connection.cursor() as cursor:
+        if numeric_from_float:
+            register_float_numeric_dumpers(cursor)
+        if logged:
+            # the rows only skip the WAL with minimal, keep it next to the timings
+            cursor.execute("SHOW wal_level")
+            note("wal_level", cursor.fetchone()[0])
+
+        # FREEZE only works inside the transaction that made the table
+        transaction = connection.transaction() if freeze else nullcontext()
+        with phase("commit"), transaction:
+            if truncate:
+                cursor.execute(table.ddl(replace=False))
+                cursor.execute(f"TRUNCATE {table.table}")
+            else:
+                cursor.execute(table.ddl())
+            with metered_copy(
+                cursor, table.copy_statement("FREEZE" if freeze else "")
+            ) as copy:
+                copy.set_types(table.types)
+                rows = phased("transform", map(table.extract, beers), count_rows=True)
+                for row in rows:
+                    copy.write_row(row)
+
+        if first_select:
+            with phase("first_select"):
+                cursor.execute(f"SELECT count(*) FROM {table.table}")
+                cursor.fetchone()
+        if vacuum:
+            with phase("vacuum"):
+                cursor.execute(f"VACUUM {table.table}")
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "insert_multirow": [
+        {"pipeline": False},
+        {"prepare": False},
+    ],
+    "copy_tuple_iterator": [
+        {"binary": True},
+    ],
+    "copy_freeze": [
+        {"freeze": False, "first_select": True, "vacuum": True},
+        {"first_select": True, "vacuum": True},
+        {"logged": True, "first_select": True, "vacuum": True},
+    ],
+}
@@ -0,0 +1,60 @@
+"""
+A local stand-in for https://api.punkapi.com/v2/beers that serves pages
+out of a beers.json (json lines) file, so the network loaders can be run
+without the real API
+
+    python punkapi_stub.py beers.json 8000
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+from typing_extensions import Self
+
+
+def make_handler(
+    beers: list[dict[str, Any]], latency: float = 0.0
+) -> type[BaseHTTPRequestHandler]:
+    class PunkApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self: Self) -> None:
+            query = parse_qs(urlparse(self.path).query)
+            page = int(query.get("page", ["1"])[0])
+            per_page = int(query.get("per_page", ["25"])[0])
+
+            # pretend to be a server on the other side of the internet
+            time.sleep(latency)
+
+            body = json.dumps(beers[(page - 1) * per_page : page * per_page])
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self: Self, format: str, *args: Any) -> None:  # noqa: A002
+            pass
+
+    return PunkApiHandler
+
+
+def serve_in_thread(
+    beers: list[dict[str, Any]], port: int = 0, latency: float = 0.0
+) -> tuple[ThreadingHTTPServer, str]:
+    """Start the stub on a background thread, returns the server (call
+    .shutdown() when done) and the url to pass to the loaders"""
+
+    server = ThreadingHTTPServer(("localhost", port), make_handler(beers, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://localhost:{server.server_port}/v2/beers"
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as fp:
+        beers = [json.loads(line) for line in fp]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    ThreadingHTTPServer(("localhost", port), make_handler(beers)).serve_forever()
@@ -0,0 +1,152 @@
+"""
+
+    The one place the staging_beers column layout is written down.
+    DDL, COPY/INSERT statements, COPY types and the row extractor
+    are all generated from STAGING_BEERS
+
+"""
+
+import datetime
+from collections.abc import Callable, Sequence
+from functools import lru_cache
+from typing import Any, NamedTuple
+
+from psycopg.postgres import types as pg_types
+from typing_extensions import Self
+
+
+@lru_cache(maxsize=4096)
+def parse_first_brewed(text: str) -> datetime.date:
+    """Turn a MM/YYYY or YYYY into datetime.date
+
+    There are only a few hundred distinct values in the data, so the
+    results are cached. Anything else is a ValueError.
+    """
+
+    parts = text.split("/")
+    try:
+        if len(parts) == 2:
+            return datetime.date(int(parts[1]), int(parts[0]), 1)
+        if len(parts) == 1:
+            return datetime.date(int(parts[0]), 1, 1)
+    except ValueError:
+        pass
+    msg = f"Unknown date format {text}"
+    raise ValueError(msg)
+
+
+class Column(NamedTuple):
+    name: str
+    type: str  # postgres type name, as psycopg's set_types knows it
+    path: str | None = None  # dotted path into the api record, default is name
+    convert: Callable[[Any], Any] | None = None  # applied to non-null values
+
+
+class TableSpec:
+    def __init__(
+        self: Self,
+        table: str,
+        columns: Sequence[Column],
+        unlogged: bool = True,
+        primary_key: Sequence[str] = (),
+    ) -> None:
+        self.table = table
+        self.columns = tuple(columns)
+        self.unlogged = unlogged
+        self.primary_key = tuple(primary_key)
+        self.names = tuple(column.name for column in self.columns)
+        self.types = tuple(column.type for column in self.columns)
+        self.extract = self._compile_extractor()
+
+    @property
+    def oids(self: Self) -> tuple[int, ...]:
+        return tuple(pg_types[type_name].oid for type_name in self.types)
+
+    def ddl(self: Self, replace: bool = True) -> str:
+        """DROP + CREATE, or with replace=False CREATE ... IF NOT EXISTS"""
+
+        width = max(map(len, self.names)) + 4
+        lines = [
+            f"            {column.name:<{width}}{column.type.upper()}"
+            for column in self.columns
+        ]
+        if self.primary_key:
+            lines.append(f"            PRIMARY KEY ({', '.join(self.primary_key)})")
+        columns = ",\n".join(lines)
+        unlogged = "UNLOGGED " if self.unlogged else ""
+        if not replace:
+            return f"""
+        CREATE {unlogged}TABLE IF NOT EXISTS {self.table} (
+{columns}
+        );"""
+        return f"""
+        DROP TABLE IF EXISTS {self.table};
+        CREATE {unlogged}TABLE {self.table} (
+{columns}
+        );"""
+
+    def copy_statement(self: Self, options: str = "") -> str:
+        statement = f"COPY {self.table}({', '.join(self.names)}) FROM STDIN"
+        return f"{statement} ({options})" if options else statement
+
+    def insert_statement(self: Self, rows: int = 1, numbered: bool = False) -> str:
+        """INSERT with `rows` rows of %s placeholders in its VALUES, or of
+        $1, $2, ... ones for PREPARE and psycopg's RawCursor"""
+
+        width = len(self.columns)
+        values = ", ".join(
+            "("
+            + ", ".join(
+                f"${row * width + column + 1}" if numbered else "%s"
+                for column in range(width)
+            )
+            + ")"
+            for row in range(rows)
+        )
+        return f"INSERT INTO {self.table}({', '.join(self.names)}) VALUES {values}"
+
+    def _compile_extractor(self: Self) -> Callable[[dict[str, Any]], tuple]:
+        """Generate `def extract(record): return (record["id"], ...)` so there
+        is no per-row loop over the column list"""
+
+        namespace: dict[str, Any] = {}
+        items = []
+        for i, column in enumerate(self.columns):
+            keys = (column.path or column.name).split(".")
+            item = "record" + "".join(f"[{key!r}]" for key in keys)
+            if column.convert is not None:
+                namespace[f"convert_{i}"] = column.convert
+                item = f"(None if (value_{i} := {item}) is None else convert_{i}(value_{i}))"
+            items.append(item)
+
+        source = f"def extract(record):\n    return ({', '.join(items)},)\n"
+        exec(compile(source, f"<{self.table} extractor>", "exec"), namespace)
+        return namespace["extract"]
+
+
+STAGING_BEERS = TableSpec(
+    "staging_beers",
+    [
+        Column("id", "integer"),  # 1
+        Column("name", "text"),  # 2
+        Column("tagline", "text"),  # 3
+        Column("first_brewed", "date", convert=parse_first_brewed),  # 4
+        Column("description", "text"),  # 5
+        Column("image_url", "text"),  # 6
+        Column("abv", "numeric"),  # 7
+        Column("ibu", "numeric"),  # 8
+        Column("target_fg", "numeric"),  # 9
+        Column("target_og", "numeric"),  # 10
+        Column("ebc", "numeric"),  # 11
+        Column("srm", "numeric"),  # 12
+        Column("ph", "numeric"),  # 13
+        Column("attenuation_level", "numeric"),  # 14
+        Column("brewers_tips", "text"),  # 15
+        Column("contributed_by", "text"),  # 16
+        Column("volume", "integer", path="volume.value"),  # 17
+    ],
+)
+
+
+# where the merge stage (merge.py) puts the staged rows for good
+BEERS = TableSpec("beers", STAGING_BEERS.columns, unlogged=False, primary_key=["id"])
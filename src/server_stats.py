@@ -0,0 +1,186 @@
+"""
+What a load cost the server, next to what it cost the client
+
+instrument.py times the client. server_costs snapshots the server's
+cumulative statistics before and after a load and hands back the
+differences:
+
+    wal_bytes, wal_records, wal_fpi     pg_current_wal_insert_lsn, pg_stat_wal
+    io_read_bytes, io_write_bytes,      pg_stat_io (postgres 16+), every
+    io_extend_bytes, io_fsyncs          process, the checkpointer included
+    checkpoints, checkpoint_buffers     pg_stat_bgwriter (pg_stat_checkpointer on 17+)
+    bgwriter_buffers                    pages the background writer cleaned
+    table_bytes                         size of the tables that are new or changed size
+    backend_cpu_seconds                 user + system time of the loader's backend
+
+All but the last two are for the whole server, so on a busy server they
+include everybody else's work too. backend_cpu_seconds needs the server
+on this machine (it's read from /proc) and only counts the backend of
+the connection the loader was given, not the extra connections some
+loaders open. The snapshots come from a connection of their own, and
+the loader's backend is made to flush its statistics first, which only
+works if its connection is in autocommit (all the open_connections are).
+"""
+
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from typing import Any, NamedTuple
+
+import psycopg
+import psycopg2
+
+# hosts for which the backend is a process on this machine
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+_monitors: dict[str, psycopg.Connection] = {}
+
+
+class ServerSnapshot(NamedTuple):
+    counters: dict[str, float]
+    tables: dict[tuple[int, int], int]  # (oid, relfilenode) -> bytes, indexes and toast included
+    backend_cpu: float | None
+
+
+def _counter_queries(version: int) -> list[str]:
+    queries = [
+        "SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), '0/0') AS wal_bytes",
+        "SELECT wal_records, wal_fpi FROM pg_stat_wal",
+    ]
+    if version >= 170000:
+        queries.append(
+            "SELECT num_timed + num_requested AS checkpoints, "
+            "buffers_written AS checkpoint_buffers FROM pg_stat_checkpointer"
+        )
+    else:
+        queries.append(
+            "SELECT checkpoints_timed + checkpoints_req AS checkpoints, "
+            "buffers_checkpoint AS checkpoint_buffers FROM pg_stat_bgwriter"
+        )
+    queries.append("SELECT buffers_clean AS bgwriter_buffers FROM pg_stat_bgwriter")
+    if version >= 180000:
+        queries.append(
+            "SELECT sum(read_bytes) AS io_read_bytes, sum(write_bytes) AS io_write_bytes, "
+            "sum(extend_bytes) AS io_extend_bytes, sum(fsyncs) AS io_fsyncs FROM pg_stat_io"
+        )
+    elif version >= 160000:
+        queries.append(
+            "SELECT sum(reads * op_bytes) AS io_read_bytes, "
+            "sum(writes * op_bytes) AS io_write_bytes, "
+            "sum(extends * op_bytes) AS io_extend_bytes, sum(fsyncs) AS io_fsyncs "
+            "FROM pg_stat_io"
+        )
+    return queries
+
+
+TABLE_SIZES = """
+    SELECT c.oid::int8, c.relfilenode::int8, pg_total_relation_size(c.oid)
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'm') AND c.relpersistence <> 't'
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        AND n.nspname NOT LIKE 'pg_toast%'"""
+
+
+def _backend(connection: Any) -> tuple[str, int, str] | None:
+    """dsn, backend pid and host of a psycopg or psycopg2 connection"""
+
+    if isinstance(connection, psycopg.Connection):
+        dsn = connection.info.dsn
+    elif isinstance(connection, psycopg2.extensions.connection):
+        dsn = connection.dsn
+    else:
+        return None
+    if connection.closed:
+        return None
+    return dsn, connection.info.backend_pid, connection.info.host
+
+
+def _monitor(dsn: str) -> psycopg.Connection:
+    monitor = _monitors.get(dsn)
+    if monitor is None or monitor.closed:
+        monitor = _monitors[dsn] = psycopg.connect(dsn, autocommit=True)
+    return monitor
+
+
+def _flush_stats(connection: Any) -> None:
+    """Have the loader's backend report its statistics now, they're
+    otherwise only sent every so often"""
+
+    if not connection.autocommit or connection.closed:
+        return
+    with suppress(psycopg.Error, psycopg2.Error), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_stat_force_next_flush()")
+
+
+def backend_cpu_seconds(pid: int, host: str) -> float | None:
+    """User + system cpu time of a backend running on this machine"""
+
+    if host not in LOCAL_HOSTS and not host.startswith("/"):
+        return None
+    try:
+        with open(f"/proc/{pid}/stat") as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    name, _, rest = stat.partition(" (")[2].rpartition(") ")
+    if not name.startswith("postgres"):
+        # some other process, in another pid namespace
+        return None
+    fields = rest.split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def take_snapshot(monitor: psycopg.Connection, pid: int, host: str) -> ServerSnapshot:
+    counters: dict[str, float] = {}
+    with monitor.cursor() as cursor:
+        for query in _counter_queries(monitor.info.server_version):
+            cursor.execute(query)
+            row = cursor.fetchone() or ()
+            names = [column.name for column in cursor.description or ()]
+            counters.update(
+                (name, float(value)) for name, value in zip(names, row) if value is not None
+            )
+        cursor.execute(TABLE_SIZES)
+        # a table dropped in the meantime has no size
+        tables = {(oid, node): size for oid, node, size in cursor if size is not None}
+    return ServerSnapshot(counters, tables, backend_cpu_seconds(pid, host))
+
+
+def difference(before: ServerSnapshot, after: ServerSnapshot) -> dict[str, float]:
+    costs = {
+        name: value - before.counters[name]
+        for name, value in after.counters.items()
+        if name in before.counters
+    }
+    costs["table_bytes"] = sum(
+        size for key, size in after.tables.items() if before.tables.get(key) != size
+    )
+    if before.backend_cpu is not None and after.backend_cpu is not None:
+        costs["backend_cpu_seconds"] = after.backend_cpu - before.backend_cpu
+    return costs
+
+
+@contextmanager
+def server_costs(connection: Any) -> Iterator[dict[str, float]]:
+    """Yields a dict that's filled in with the server's costs on the way
+    out, left empty for things that aren't a psycopg or psycopg2
+    connection, or if the server can't be asked"""
+
+    costs: dict[str, float] = {}
+    backend = _backend(connection)
+    before = None
+    if backend is not None:
+        dsn, pid, host = backend
+        try:
+            monitor = _monitor(dsn)
+            _flush_stats(connection)
+            before = take_snapshot(monitor, pid, host)
+        except psycopg.Error as error:
+            print(f"No server statistics: {error}")
+    try:
+        yield costs
+    finally:
+        if before is not None:
+            with suppress(psycopg.Error):
+                _flush_stats(connection)
+                costs.update(difference(before, take_snapshot(monitor, pid, host)))
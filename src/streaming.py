@@ -0,0 +1,114 @@
+"""
+Streaming json lines input, so memory doesn't grow with the file
+
+save_beers_json writes one api record per line. Instead of reading that
+back into a list first, these readers hand out records (or arrow batches)
+as they go, a chunk of the file at a time. Plain, gzip and zstd files
+all work, the compression is sniffed from the first bytes.
+
+    copy_tuple_iterator(connection, iter_jsonl("beers.json.zst"))
+
+orjson is used to parse the lines when it's installed (pip install
+'fast-load-experiments[fast]').
+"""
+
+import io
+from collections.abc import Iterator
+from typing import Any
+
+import psycopg
+import pyarrow as pa
+import pyarrow.json as pa_json
+from psycopg_implementation import copy_tuple_iterator
+from transforms import raw_json_schema
+from utils import create_staging_table, profile
+from with_pgpq import copy_batches
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+MAGIC_BYTES = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+
+def compression(path: str) -> str | None:
+    """gzip, zstd or None, going by the first bytes of the file"""
+
+    with open(path, "rb") as fp:
+        head = fp.read(4)
+    for magic, codec in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_jsonl(path: str) -> pa.NativeFile:
+    """The decompressed content of path, as a stream"""
+
+    return pa.input_stream(path, compression=compression(path))
+
+
+def iter_jsonl(path: str, chunk_bytes: int = 2**20) -> Iterator[dict[str, Any]]:
+    """One record per line, parsed about `chunk_bytes` of lines at a time"""
+
+    with open_jsonl(path) as stream:
+        reader = io.BufferedReader(stream, buffer_size=chunk_bytes)
+        while lines := reader.readlines(chunk_bytes):
+            yield from map(loads, lines)
+
+
+def iter_jsonl_batches(path: str, block_size: int = 2**22) -> Iterator[pa.RecordBatch]:
+    """Arrow batches of the fields staging_beers needs, each parsed from
+    about `block_size` bytes of the file"""
+
+    with open_jsonl(path) as stream:
+        yield from pa_json.open_json(
+            stream,
+            read_options=pa_json.ReadOptions(block_size=block_size),
+            parse_options=pa_json.ParseOptions(
+                explicit_schema=raw_json_schema(),
+                unexpected_field_behavior="ignore",
+            ),
+        )
+
+
+# --> Loaders
+
+@profile
+def copy_jsonl(
+    connection: psycopg.Connection,
+    whichfile: str,
+    binary: bool = False,
+    numeric_from_float: bool = True,
+) -> None:
+    """copy_tuple_iterator, fed straight from the file"""
+
+    copy_tuple_iterator.__wrapped__(
+        connection,
+        iter_jsonl(whichfile),
+        binary=binary,
+        numeric_from_float=numeric_from_float,
+    )
+
+
+@profile
+def copy_jsonl_pgpq(
+    connection: psycopg.Connection, whichfile: str, block_size: int = 2**22
+) -> None:
+    """Arrow's json reader parses, pgpq encodes, no python per row"""
+
+    create_staging_table(connection)
+    with connection.cursor() as cursor:
+        copy_batches(cursor, iter_jsonl_batches(whichfile, block_size))
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_jsonl": [
+        {"binary": True},
+    ],
+}
@@ -0,0 +1,343 @@
+"""
+Made-up api records, as many as wanted, every one of them its own object
+
+The api only has a few hundred beers, and `beers * 100` is the same
+dicts a hundred times over: the memory numbers count each dict once and
+every cache (parse_first_brewed's, the CPU's) sees the same values
+again and again. SyntheticBeers makes records shaped like the api's,
+with unique ids and names, the nested malts, hops and so on, and the
+same values for the same seed on every run:
+
+    beers = SyntheticBeers(10**6, seed=1)
+    copy_tuple_iterator(connection, beers)         # generated as it's read
+    write_jsonl(beers, "beers.json.zst")           # or straight to a file
+
+Records are generated CHUNK_RECORDS at a time, each chunk from its own
+seeded generator, so a slice (or a single record) doesn't need the ones
+before it and nothing holds more than a chunk. String lengths, the null
+rate, the first_brewed formats and the list lengths are in
+SyntheticOptions. From the command line:
+
+    python -m synthetic 10000000 beers.json.zst --seed 1
+    python -m synthetic 10000000 beers.parquet
+"""
+
+import argparse
+import json
+import random
+import sys
+from collections.abc import Iterable, Iterator, Sequence
+from itertools import islice
+from typing import Any, NamedTuple, overload
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing_extensions import Self
+
+CHUNK_RECORDS = 4096
+
+_ADJECTIVES = (
+    "Hazy", "Black", "Punk", "Dead", "Elvis", "Hoppy", "Sour", "Imperial", "Smoked",
+    "Wild", "Golden", "Dark", "Bitter", "Lost", "Double", "Tropical", "Russian",
+)
+_NOUNS = (
+    "Pony", "Jane", "Hammer", "Juice", "Sabotage", "Lager", "Porter", "Stout",
+    "Saison", "Dog", "Monk", "Abbey", "Tokyo", "Circus", "Anchor", "Comet",
+)
+_WORDS = (
+    "a", "the", "and", "of", "with", "hops", "malt", "citrus", "pine", "caramel",
+    "toffee", "bitter", "sweet", "roasted", "coffee", "chocolate", "it's", "notes,",
+    "finish.", "aroma", "body", "smooth", "dry", "crisp", "tropical", "fruit",
+    "resinous", "grapefruit,", "barrel-aged", "oak", "vanilla", "brewed", "batch",
+)
+_MALTS = (
+    "Maris Otter", "Extra Pale", "Caramalt", "Munich", "Crystal 150", "Dark Crystal",
+    "Wheat", "Chocolate", "Carafa Special Malt Type 3", "Acidulated Malt", "Flaked Oats",
+)
+_HOPS = (
+    "Fuggles", "First Gold", "Cascade", "Amarillo", "Simcoe", "Centennial",
+    "Chinook", "Citra", "Mosaic", "Nelson Sauvin", "Magnum", "Ahtanum",
+)
+_HOP_ADDS = ("start", "middle", "end", "dry hop")
+_HOP_ATTRIBUTES = ("bitter", "flavour", "aroma")
+_YEASTS = ("Wyeast 1056 - American Ale", "Wyeast 1272 - American Ale II",
+           "WLP001 - California Ale", "Wyeast 3711 - French Saison")
+_FOODS = ("Spicy chicken", "Cheese", "Chocolate cake", "Smoked salmon", "Pulled pork",
+          "Thai green curry", "Blue cheese", "Lemon tart", "Oysters", "Burger")
+_CONTRIBUTORS = ("Sam Mason <samjbmason>", "Ali Skinner <AliSkinner>",
+                 "Alex Jones <alexjones>", "Jo Bloggs <jbloggs>")
+
+
+class SyntheticOptions(NamedTuple):
+    description_words: tuple[int, int] = (10, 80)  # (min, max) words
+    tagline_words: tuple[int, int] = (2, 6)
+    tips_words: tuple[int, int] = (5, 40)
+    null_rate: float = 0.05  # of the fields the api sometimes leaves null
+    month_year_rate: float = 0.5  # first_brewed as MM/YYYY, the rest YYYY
+    newline_rate: float = 0.02  # text with an embedded newline, to keep escaping honest
+    malts: tuple[int, int] = (1, 6)
+    hops: tuple[int, int] = (1, 8)
+    mash_temps: tuple[int, int] = (1, 2)
+    food_pairings: tuple[int, int] = (1, 4)
+
+
+def generate_chunk(
+    seed: int, chunk_no: int, options: SyntheticOptions = SyntheticOptions()
+) -> list[dict[str, Any]]:
+    """Records chunk_no * CHUNK_RECORDS + 1 ... (ids count from 1), the
+    same ones for the same seed, chunk_no and options"""
+
+    rng = random.Random(seed * 2**32 + chunk_no)
+    # random.randint and random.choice go through a few layers of checks
+    # per call, with a dozen or more calls per record that adds up
+    rand, choices = rng.random, rng.choices
+    null_rate = options.null_rate
+
+    def between(low: int, high: int) -> int:
+        return low + int(rand() * (high - low + 1))
+
+    def pick(values: Sequence[Any]) -> Any:
+        return values[int(rand() * len(values))]
+
+    def measure(low: float, high: float) -> float:
+        return round(low + (high - low) * rand(), 1)
+
+    def text(words: tuple[int, int]) -> str:
+        chosen = choices(_WORDS, k=between(*words))
+        if rand() < options.newline_rate:
+            chosen.insert(between(0, len(chosen)), "\n")
+        return " ".join(chosen)
+
+    def nullable(value: Any) -> Any:
+        return None if rand() < null_rate else value
+
+    records = []
+    first_id = chunk_no * CHUNK_RECORDS + 1
+    for beer_id in range(first_id, first_id + CHUNK_RECORDS):
+        year = between(2007, 2024)
+        records.append({
+            "id": beer_id,
+            "name": f"{pick(_ADJECTIVES)} {pick(_NOUNS)} {beer_id}",
+            "tagline": text(options.tagline_words),
+            "first_brewed": (
+                f"{between(1, 12):02d}/{year}" if rand() < options.month_year_rate else str(year)
+            ),
+            "description": text(options.description_words),
+            "image_url": nullable(f"https://images.example.com/{beer_id}.png"),
+            "abv": measure(0.5, 18),
+            "ibu": nullable(measure(5, 250)),
+            "target_fg": nullable(measure(1000, 1030)),
+            "target_og": nullable(measure(1030, 1120)),
+            "ebc": nullable(measure(4, 600)),
+            "srm": nullable(measure(2, 300)),
+            "ph": nullable(measure(3.2, 5.6)),
+            "attenuation_level": nullable(measure(60, 95)),
+            "volume": {"value": 20, "unit": "litres"},
+            "boil_volume": {"value": 25, "unit": "litres"},
+            "method": {
+                "mash_temp": [
+                    {"temp": {"value": between(60, 72), "unit": "celsius"},
+                     "duration": nullable(between(10, 90))}
+                    for _ in range(between(*options.mash_temps))
+                ],
+                "fermentation": {"temp": {"value": between(9, 25), "unit": "celsius"}},
+                "twist": text((2, 10)) if rand() < 0.2 else None,
+            },
+            "ingredients": {
+                "malt": [
+                    {"name": name, "amount": {"value": measure(0.1, 6.5), "unit": "kilograms"}}
+                    for name in choices(_MALTS, k=between(*options.malts))
+                ],
+                "hops": [
+                    {"name": name, "amount": {"value": measure(5, 100), "unit": "grams"},
+                     "add": pick(_HOP_ADDS), "attribute": pick(_HOP_ATTRIBUTES)}
+                    for name in choices(_HOPS, k=between(*options.hops))
+                ],
+                "yeast": nullable(pick(_YEASTS)),
+            },
+            "food_pairing": choices(_FOODS, k=between(*options.food_pairings)),
+            "brewers_tips": nullable(text(options.tips_words)),
+            "contributed_by": pick(_CONTRIBUTORS),
+        })
+    return records
+
+
+class SyntheticBeers(Sequence[dict[str, Any]]):
+    """count records for seed, generated when they're read. Slicing gives
+    another SyntheticBeers, so it stays cheap, and it pickles small"""
+
+    def __init__(
+        self: Self,
+        count: int,
+        seed: int = 0,
+        options: SyntheticOptions = SyntheticOptions(),
+        start: int = 0,
+    ) -> None:
+        self.count = count
+        self.seed = seed
+        self.options = options
+        self.start = start
+        self._cached: tuple[int, list[dict[str, Any]]] | None = None
+
+    def __len__(self: Self) -> int:
+        return self.count
+
+    def __reduce__(self: Self) -> tuple[Any, ...]:
+        # without the cached chunk
+        return type(self), (self.count, self.seed, self.options, self.start)
+
+    def __repr__(self: Self) -> str:
+        return f"SyntheticBeers({self.count}, seed={self.seed}, start={self.start})"
+
+    def _chunk(self: Self, chunk_no: int) -> list[dict[str, Any]]:
+        if self._cached is None or self._cached[0] != chunk_no:
+            self._cached = (chunk_no, generate_chunk(self.seed, chunk_no, self.options))
+        return self._cached[1]
+
+    @overload
+    def __getitem__(self: Self, index: int) -> dict[str, Any]: ...
+
+    @overload
+    def __getitem__(self: Self, index: slice) -> "SyntheticBeers": ...
+
+    def __getitem__(self: Self, index: int | slice) -> Any:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return type(self)(max(stop - start, 0), self.seed, self.options, self.start + start)
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            msg = f"SyntheticBeers index {index} out of range"
+            raise IndexError(msg)
+        chunk_no, offset = divmod(self.start + index, CHUNK_RECORDS)
+        return self._chunk(chunk_no)[offset]
+
+    def __iter__(self: Self) -> Iterator[dict[str, Any]]:
+        # a fresh list of dicts per chunk, nothing is shared between records
+        first, offset = divmod(self.start, CHUNK_RECORDS)
+        remaining = self.count
+        chunk_no = first
+        while remaining > 0:
+            chunk = generate_chunk(self.seed, chunk_no, self.options)[offset : offset + remaining]
+            yield from chunk
+            remaining -= len(chunk)
+            chunk_no += 1
+            offset = 0
+
+
+# --> Writing files
+
+# the whole of a record, for parquet, nulls and all
+_AMOUNT = pa.struct([("value", pa.float64()), ("unit", pa.string())])
+RECORD_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("name", pa.string()),
+    ("tagline", pa.string()),
+    ("first_brewed", pa.string()),
+    ("description", pa.string()),
+    ("image_url", pa.string()),
+    ("abv", pa.float64()),
+    ("ibu", pa.float64()),
+    ("target_fg", pa.float64()),
+    ("target_og", pa.float64()),
+    ("ebc", pa.float64()),
+    ("srm", pa.float64()),
+    ("ph", pa.float64()),
+    ("attenuation_level", pa.float64()),
+    ("volume", pa.struct([("value", pa.int64()), ("unit", pa.string())])),
+    ("boil_volume", pa.struct([("value", pa.int64()), ("unit", pa.string())])),
+    ("method", pa.struct([
+        ("mash_temp", pa.list_(pa.struct([
+            ("temp", pa.struct([("value", pa.int64()), ("unit", pa.string())])),
+            ("duration", pa.int64()),
+        ]))),
+        ("fermentation", pa.struct([
+            ("temp", pa.struct([("value", pa.int64()), ("unit", pa.string())])),
+        ])),
+        ("twist", pa.string()),
+    ])),
+    ("ingredients", pa.struct([
+        ("malt", pa.list_(pa.struct([("name", pa.string()), ("amount", _AMOUNT)]))),
+        ("hops", pa.list_(pa.struct([
+            ("name", pa.string()),
+            ("amount", _AMOUNT),
+            ("add", pa.string()),
+            ("attribute", pa.string()),
+        ]))),
+        ("yeast", pa.string()),
+    ])),
+    ("food_pairing", pa.list_(pa.string())),
+    ("brewers_tips", pa.string()),
+    ("contributed_by", pa.string()),
+])
+
+_COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+
+def write_jsonl(
+    beers: Iterable[dict[str, Any]], path: str, compression: str | None = "infer"
+) -> int:
+    """One record per line, gzip or zstd going by the file name unless
+    compression says otherwise. Returns the number of records"""
+
+    if compression == "infer":
+        compression = next(
+            (codec for suffix, codec in _COMPRESSION_SUFFIXES.items() if path.endswith(suffix)),
+            None,
+        )
+    count = 0
+    records = iter(beers)
+    with pa.output_stream(path, compression=compression) as stream:
+        while chunk := list(islice(records, CHUNK_RECORDS)):
+            stream.write("".join(json.dumps(beer) + "\n" for beer in chunk).encode())
+            count += len(chunk)
+    return count
+
+
+def write_parquet(
+    beers: Iterable[dict[str, Any]], path: str, row_group_size: int = 65_536
+) -> int:
+    """The records as parquet, a row group at a time. Returns the number
+    of records"""
+
+    count = 0
+    records = iter(beers)
+    with pq.ParquetWriter(path, RECORD_SCHEMA) as writer:
+        while chunk := list(islice(records, row_group_size)):
+            writer.write_table(pa.Table.from_pylist(chunk, schema=RECORD_SCHEMA))
+            count += len(chunk)
+    return count
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m synthetic", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("count", type=int, help="number of records")
+    parser.add_argument("path", help=".parquet, or json lines (.gz and .zst are compressed)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--null-rate", type=float, default=SyntheticOptions().null_rate)
+    parser.add_argument("--month-year-rate", type=float,
+                        default=SyntheticOptions().month_year_rate,
+                        help="share of first_brewed values as MM/YYYY instead of YYYY")
+    parser.add_argument("--description-words", type=int, nargs=2,
+                        default=SyntheticOptions().description_words, metavar=("MIN", "MAX"))
+    args = parser.parse_args(argv)
+
+    options = SyntheticOptions(
+        description_words=tuple(args.description_words),
+        null_rate=args.null_rate,
+        month_year_rate=args.month_year_rate,
+    )
+    beers = SyntheticBeers(args.count, args.seed, options)
+    if args.path.endswith(".parquet"):
+        count = write_parquet(beers, args.path)
+    else:
+        count = write_jsonl(beers, args.path)
+    print(f"Wrote {count} records to {args.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
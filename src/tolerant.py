@@ -0,0 +1,307 @@
+"""
+COPY that sets bad rows aside instead of failing the whole load
+
+A single row the server won't take (an integer out of range, a value
+that doesn't cast) aborts a COPY, and with it every good row in it.
+copy_tolerant sends chunks of `chunk_rows` rows, each in its own
+transaction. When a chunk fails, the bad row is usually known: the
+server's error says which line of the COPY data it was, and an error
+raised while encoding is raised by the row being written. That row goes
+to the quarantine, with the error, the rows before it are sent again
+and the COPY carries on after it. When the error doesn't say, the chunk
+is bisected: split in two and each half tried again, down to the single
+rows that fail. Records that don't even make it through
+STAGING_BEERS.extract (a first_brewed in an unknown format) are
+quarantined straight away. A TypeError raised on the client for a row
+whose values all have the types extract hands out (a float for a
+numeric column, ...) stops the load instead: that's psycopg with no way
+to dump one of them (the float dumpers missing, say), not a bad row.
+
+The quarantine is the staging_beers_rejects table, or a json lines file:
+
+    result = copy_tolerant(connection, beers)
+    result = copy_tolerant(connection, beers, quarantine="rejects.jsonl")
+
+A clean chunk costs one COPY. A bad row that can be pointed at costs
+one more COPY, of the chunk's rows from the one before it, one that
+has to be found by bisection about 2 * log2(chunk_rows) of them. After
+a failure the chunks get smaller for a while, so a patch of bad rows
+doesn't send the same big chunk over and over.
+"""
+
+import json
+import re
+import time
+import uuid
+from collections.abc import Iterable, Iterator, Sequence
+from datetime import date
+from decimal import Decimal
+from itertools import islice
+from typing import Any, NamedTuple
+
+import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, metered_copy, phase, phased
+from psycopg.types.json import Json
+from schema import STAGING_BEERS
+from typing_extensions import Self
+from utils import create_staging_table, profile
+
+REJECTS_TABLE = "staging_beers_rejects"
+
+# logged, unlike staging_beers, the rejects are what's left to fix. JSON
+# and not JSONB, jsonb can't hold a \u0000 and that may be why it's here
+REJECTS_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {REJECTS_TABLE} (
+        load_id         TEXT,
+        record          JSON,
+        error           TEXT,
+        rejected_at     TIMESTAMPTZ DEFAULT now()
+    );"""
+
+# what a bad value raises on the client, before the server sees it
+CLIENT_ERRORS = (KeyError, TypeError, ValueError)
+
+# the python types STAGING_BEERS.extract gives the columns of a good record
+EXTRACTED_TYPES = {
+    "integer": (int,),
+    "numeric": (int, float, Decimal),
+    "text": (str,),
+    "date": (date,),
+}
+
+# how small chunks get after failures, chunk_rows is how big they get again
+MIN_CHUNK_ROWS = 100
+
+# the CONTEXT of an error in COPY data
+_COPY_LINE_RE = re.compile(r"^COPY \S+, line (\d+)")
+
+
+class Reject(NamedTuple):
+    record: dict[str, Any]
+    error: str
+
+
+class TolerantResult(NamedTuple):
+    load_id: str
+    loaded: int
+    rejected: int
+    failed_chunks: int  # chunks that had to be split up
+    seconds: float
+    retry_seconds: float  # spent in failed COPYs and on picking them apart
+
+    @property
+    def overhead(self: Self) -> float:
+        """Share of the time that went to dealing with bad rows"""
+
+        return self.retry_seconds / self.seconds if self.seconds else 0.0
+
+
+def _extract(
+    beers: Iterable[dict[str, Any]], rejects: list[Reject]
+) -> Iterator[tuple[dict[str, Any], tuple]]:
+    for beer in beers:
+        try:
+            yield beer, STAGING_BEERS.extract(beer)
+        except CLIENT_ERRORS as error:
+            rejects.append(Reject(beer, repr(error)))
+
+
+def _dumps(obj: Any) -> str:
+    # a record that failed may hold anything, not just json types
+    return json.dumps(obj, default=str)
+
+
+def write_rejects(
+    cursor: psycopg.Cursor, load_id: str, rejects: list[Reject], path: str | None = None
+) -> None:
+    """Append to the json lines file at path, or to staging_beers_rejects"""
+
+    if path is not None:
+        with open(path, "a") as fp:
+            for reject in rejects:
+                line = {"load_id": load_id, "record": reject.record, "error": reject.error}
+                fp.write(_dumps(line) + "\n")
+        return
+    cursor.executemany(
+        f"INSERT INTO {REJECTS_TABLE}(load_id, record, error) VALUES (%s, %s, %s)",
+        [(load_id, Json(reject.record, dumps=_dumps), reject.error) for reject in rejects],
+    )
+
+
+def _well_typed(row: Sequence[Any]) -> bool:
+    return all(
+        value is None or isinstance(value, EXTRACTED_TYPES.get(type_name, object))
+        for value, type_name in zip(row, STAGING_BEERS.types)
+    )
+
+
+def _failed_row(error: Exception, writing: int | None) -> int | None:
+    """Which row made the COPY fail, if that can be told without bisecting"""
+
+    if isinstance(error, psycopg.Error) and error.sqlstate:
+        # the server names the line of the COPY data
+        match = _COPY_LINE_RE.search(error.diag.context or "")
+        return int(match.group(1)) - 1 if match else None
+    # raised on the client, while encoding the row being written
+    return writing
+
+
+def _copy_chunk(
+    connection: psycopg.Connection,
+    cursor: psycopg.Cursor,
+    pairs: list[tuple[dict[str, Any], tuple]],
+) -> tuple[Exception | None, int | None]:
+    """COPY the rows in a transaction of their own. If that failed (and
+    was rolled back), the error and the position of the bad row, if known.
+    A row psycopg can't dump though it's well typed is raised"""
+
+    writing = None
+    try:
+        with connection.transaction():
+            with metered_copy(cursor, STAGING_BEERS.copy_statement()) as copy:
+                copy.set_types(STAGING_BEERS.types)
+                for writing, (_, row) in enumerate(pairs):
+                    copy.write_row(row)
+                writing = None
+    except (psycopg.Error, *CLIENT_ERRORS) as error:
+        # a lost connection or missing dumpers aren't the data's fault
+        if connection.broken:
+            raise
+        if (
+            isinstance(error, TypeError)
+            and writing is not None
+            and _well_typed(pairs[writing][1])
+        ):
+            raise
+        return error, _failed_row(error, writing)
+    return None, None
+
+
+def _bisect(
+    connection: psycopg.Connection,
+    cursor: psycopg.Cursor,
+    pairs: list[tuple[dict[str, Any], tuple]],
+    rejects: list[Reject],
+    known_bad: bool = False,
+) -> int:
+    """Load what can be loaded of rows that failed as a whole, reject
+    the rest, and return how many rows went in"""
+
+    if len(pairs) == 1 or not known_bad:
+        error, _ = _copy_chunk(connection, cursor, pairs)
+        if error is None:
+            return len(pairs)
+        if len(pairs) == 1:
+            rejects.append(Reject(pairs[0][0], str(error).strip()))
+            return 0
+    middle = len(pairs) // 2
+    loaded = _bisect(connection, cursor, pairs[:middle], rejects)
+    # the whole failed, so if the first half went in the bad rows are in
+    # the second one, no need to try it in one piece
+    return loaded + _bisect(
+        connection, cursor, pairs[middle:], rejects, known_bad=loaded == middle
+    )
+
+
+def _salvage(
+    connection: psycopg.Connection,
+    cursor: psycopg.Cursor,
+    pairs: list[tuple[dict[str, Any], tuple]],
+    error: Exception,
+    position: int | None,
+    rejects: list[Reject],
+) -> int:
+    """Load the good rows of a chunk that failed, return how many"""
+
+    loaded = 0
+    while True:
+        if position is None:
+            return loaded + _bisect(connection, cursor, pairs, rejects, known_bad=True)
+        rejects.append(Reject(pairs[position][0], str(error).strip()))
+        # the rows before the bad one were fine, they only went back with
+        # the failed COPY
+        if position:
+            loaded += _bisect(connection, cursor, pairs[:position], rejects)
+        pairs = pairs[position + 1 :]
+        if not pairs:
+            return loaded
+        error, position = _copy_chunk(connection, cursor, pairs)
+        if error is None:
+            return loaded + len(pairs)
+
+
+# --> Loaders
+
+@profile
+def copy_tolerant(
+    connection: psycopg.Connection,
+    beers: Iterable[dict[str, Any]],
+    chunk_rows: int = 10_000,
+    quarantine: str | None = None,
+    numeric_from_float: bool = True,
+) -> TolerantResult:
+    """COPY beers into staging_beers, quarantining the rows that fail
+
+    quarantine is the path of a json lines file to append the rejects
+    to, by default they go to staging_beers_rejects. Every reject is
+    tagged with the load_id of the result. numeric_from_float is the
+    same as for copy_tuple_iterator.
+    """
+
+    load_id = uuid.uuid4().hex
+    start = time.perf_counter()
+    loaded = rejected = failed_chunks = 0
+    retry_seconds = 0.0
+
+    with connection.cursor() as cursor:
+        if numeric_from_float:
+            register_float_numeric_dumpers(cursor)
+        create_staging_table(cursor)
+        if quarantine is None:
+            cursor.execute(REJECTS_DDL)
+
+        rejects: list[Reject] = []
+        pairs = _extract(phased("transform", beers), rejects)
+        size = chunk_rows
+        while True:
+            chunk = list(islice(pairs, size))
+            if chunk:
+                t = time.perf_counter()
+                with phase("commit"):
+                    error, position = _copy_chunk(connection, cursor, chunk)
+                if error is None:
+                    chunk_loaded = len(chunk)
+                    size = min(size * 2, chunk_rows)
+                else:
+                    # where there's one bad row there are often more, a
+                    # smaller chunk wastes less on the next one
+                    size = min(max(size // 4, MIN_CHUNK_ROWS), chunk_rows)
+                    failed_chunks += 1
+                    with phase("retry"):
+                        chunk_loaded = _salvage(
+                            connection, cursor, chunk, error, position, rejects
+                        )
+                    retry_seconds += time.perf_counter() - t
+                loaded += chunk_loaded
+                add_rows(chunk_loaded)
+
+            if rejects:
+                with phase("retry"):
+                    write_rejects(cursor, load_id, rejects, quarantine)
+                rejected += len(rejects)
+                rejects.clear()
+            if not chunk:
+                break
+
+    return TolerantResult(
+        load_id, loaded, rejected, failed_chunks, time.perf_counter() - start, retry_seconds
+    )
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_tolerant": [
+        {"chunk_rows": 1_000},
+    ],
+}
@@ -0,0 +1,146 @@
+"""
+Column-at-a-time versions of the staging_beers transforms, for loaders
+that hold their data as arrow batches instead of python rows
+"""
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from schema import STAGING_BEERS, parse_first_brewed
+
+# The DECIMAL columns are floats in the json/parquet files. Arrow decimals
+# go over the wire as binary numerics, so pick a scale big enough for the
+# data. to_numeric refuses values that don't fit instead of rounding them
+NUMERIC = pa.decimal128(38, 6)
+
+ARROW_TYPES = {
+    "integer": pa.int32(),
+    "text": pa.string(),
+    "date": pa.date32(),
+    "numeric": NUMERIC,
+}
+
+STAGING_SCHEMA = pa.schema(
+    [
+        (column.name, ARROW_TYPES[column.type])
+        for column in STAGING_BEERS.columns
+    ]
+)
+
+
+# how the staging_beers columns look in the api json, before any cleaning
+RAW_JSON_TYPES = {
+    "integer": pa.int64(),
+    "text": pa.string(),
+    "date": pa.string(),
+    "numeric": pa.float64(),
+}
+
+
+def raw_json_schema() -> pa.Schema:
+    """Just the fields of the api records that staging_beers uses, nested
+    paths as structs. A json reader given this as its explicit schema
+    doesn't have to guess types from the first block"""
+
+    fields: dict[str, pa.DataType] = {}
+    for column in STAGING_BEERS.columns:
+        top, *nested = (column.path or column.name).split(".")
+        data_type = RAW_JSON_TYPES[column.type]
+        for key in reversed(nested):
+            data_type = pa.struct([(key, data_type)])
+        fields[top] = data_type
+    return pa.schema(list(fields.items()))
+
+
+def _parse_first_brewed_values(values: pa.Array) -> pa.Array:
+    parts = pc.extract_regex(values, r"^(?:(?P<month>\d{1,2})/)?(?P<year>\d{4})$")
+    month = pc.struct_field(parts, "month")
+    month = pc.if_else(pc.equal(month, ""), "01", pc.utf8_lpad(month, 2, "0"))
+    iso = pc.binary_join_element_wise(
+        pc.struct_field(parts, "year"), month, "01", "-"
+    )
+    dates = pc.cast(
+        pc.strptime(iso, format="%Y-%m-%d", unit="s", error_is_null=True),
+        pa.date32(),
+    )
+
+    leftovers = pc.and_(pc.is_valid(values), pc.is_null(dates))
+    if pc.any(leftovers).as_py():
+        dates = pc.replace_with_mask(
+            dates,
+            leftovers,
+            pa.array(
+                [parse_first_brewed(text) for text in pc.filter(values, leftovers).to_pylist()],
+                pa.date32(),
+            ),
+        )
+    return dates
+
+
+def parse_first_brewed_column(column: pa.Array | pa.ChunkedArray) -> pa.Array:
+    """Vectorized parse_first_brewed: MM/YYYY or YYYY into date32
+
+    Only the distinct values are parsed, then spread back out with a take.
+    The compute kernels handle the two expected formats. Whatever they
+    can't parse is sent through the scalar parse_first_brewed, so odd
+    but valid values come out the same and bad values raise the same
+    ValueError as the row-at-a-time loaders.
+    """
+
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    encoded = pc.dictionary_encode(column)
+    return pc.take(_parse_first_brewed_values(encoded.dictionary), encoded.indices)
+
+
+def to_numeric(values: pa.Array | pa.ChunkedArray, name: str) -> pa.Array | pa.ChunkedArray:
+    """Cast to NUMERIC. Floats go by way of their shortest repr, the digits
+    the psycopg loaders send, so both store the same value. A value with
+    more decimal places than NUMERIC's scale raises ValueError, a plain
+    cast would round it"""
+
+    if pa.types.is_floating(values.type):
+        # float -> decimal directly is the binary expansion, 0.1 -> 0.100000000000000005...
+        values = pc.cast(values, pa.string())
+    try:
+        return pc.cast(values, NUMERIC)
+    except pa.ArrowInvalid as error:
+        msg = f"{name} has a value with more than {NUMERIC.scale} decimal places ({error})"
+        raise ValueError(msg) from error
+
+
+def cast_batch(batch: pa.RecordBatch, schema: pa.Schema = STAGING_SCHEMA) -> pa.RecordBatch:
+    """batch.cast(schema) for a batch that already has the staging_beers
+    columns, with the NUMERIC ones through to_numeric"""
+
+    columns = [
+        to_numeric(values, field.name) if field.type == NUMERIC else pc.cast(values, field.type)
+        for values, field in zip(batch.columns, schema)
+    ]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+# vectorized stand-ins for the scalar Column.convert functions
+ARROW_CONVERTERS = {
+    parse_first_brewed: parse_first_brewed_column,
+}
+
+
+def to_staging_batch(
+    batch: pa.RecordBatch, schema: pa.Schema = STAGING_SCHEMA
+) -> pa.RecordBatch:
+    """Reshape a batch of raw api records into staging_beers column order
+    and types, or the types of another schema with the same columns"""
+
+    columns = []
+    for column, field in zip(STAGING_BEERS.columns, schema):
+        top, *nested = (column.path or column.name).split(".")
+        values = batch.column(top)
+        for key in nested:
+            values = pc.struct_field(values, key)
+        if column.convert is not None:
+            values = ARROW_CONVERTERS[column.convert](values)
+        if field.type == NUMERIC:
+            columns.append(to_numeric(values, column.name))
+        else:
+            columns.append(pc.cast(values, field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
@@ -4,42 +4,48 @@
 
 """
 
-import datetime
+import hashlib
+import io
+import json
+import os
 import time
-from collections.abc import Callable, Iterator
-from functools import wraps
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import cache, partial, wraps
+from itertools import chain, islice
 from typing import Any
 from urllib.parse import urlencode
 
 import psycopg
 import psycopg2
 import requests
-from memory_profiler import memory_usage
+from typing_extensions import Self
+
+from instrument import RECORDS, measure, note, phase, phased
+from schema import STAGING_BEERS
+from server_stats import server_costs
 
 #  --> Data fetching related
 
-def parse_first_brewed(text: str) -> datetime.date:
-    """Turn a MM/YYYY or YYYY into datetime.date"""
+PUNKAPI_URL = "https://api.punkapi.com/v2/beers"
+
 
-    parts = text.split("/")
-    if len(parts) == 2:
-        return datetime.date(int(parts[1]), int(parts[0]), 1)
-    if len(parts) == 1:
-        return datetime.date(int(parts[0]), 1, 1)
-    assert False, f"Unknown date format {text}"
+def get_page(
+    session: requests.Session, url: str, page: int, page_size: int
+) -> list[dict[str, Any]]:
+    response = session.get(url + "?" + urlencode({"page": page, "per_page": page_size}))
+    response.raise_for_status()
+    return response.json()
 
 
-def iter_beers_from_api(page_size: int = 5) -> Iterator[dict[str, Any]]:
+def iter_beers_from_api(
+    page_size: int = 5, url: str = PUNKAPI_URL
+) -> Iterator[dict[str, Any]]:
     session = requests.Session()
     page = 1
     while True:
-        response = session.get(
-            "https://api.punkapi.com/v2/beers?"
-            + urlencode({"page": page, "per_page": page_size})
-        )
-        response.raise_for_status()
-
-        data = response.json()
+        data = get_page(session, url, page, page_size)
         if not data:
             break
 
@@ -48,34 +54,92 @@ def iter_beers_from_api(page_size: int = 5) -> Iterator[dict[str, Any]]:
         page += 1
 
 
-# using cache to take network out of performance analysis
-# copy dataset 100x to get "big" data
-beers = list(iter_beers_from_api()) * 100
+def crawl_beers(
+    page_size: int = 80, workers: int = 8, url: str = PUNKAPI_URL
+) -> list[dict[str, Any]]:
+    """Same records as iter_beers_from_api, but big pages fetched
+    `workers` at a time"""
+
+    session = requests.Session()
+    beers: list[dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        first_page = 1
+        while True:
+            pages = pool.map(
+                lambda page: get_page(session, url, page, page_size),
+                range(first_page, first_page + workers),
+            )
+            for data in pages:
+                if not data:
+                    return beers
+                beers.extend(data)
+            first_page += workers
+
+
+# --> On-disk cache of the api data, to take the network out of
+#     performance analysis. The cache is json lines plus a sha256 of
+#     the file in a sidecar, a cache that doesn't match gets re-crawled
+
+BEERS_CACHE = os.environ.get("BEERS_CACHE", "beers_cache.jsonl")
+
+
+def _cache_is_valid(path: str) -> bool:
+    try:
+        with open(path, "rb") as fp:
+            content = fp.read()
+        with open(path + ".sha256") as fp:
+            expected = fp.read().strip()
+    except FileNotFoundError:
+        return False
+    return hashlib.sha256(content).hexdigest() == expected
+
+
+def _write_cache(path: str, beers: list[dict[str, Any]]) -> None:
+    content = "".join(json.dumps(beer) + "\n" for beer in beers).encode()
+    with open(path, "wb") as fp:
+        fp.write(content)
+    with open(path + ".sha256", "w") as fp:
+        fp.write(hashlib.sha256(content).hexdigest())
+
+
+@cache
+def load_beers(path: str = BEERS_CACHE) -> list[dict[str, Any]]:
+    """The api records, read from the cache, crawling only on a cache miss"""
+
+    if not _cache_is_valid(path):
+        _write_cache(path, crawl_beers())
+    with open(path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def get_beers(multiplier: int = 100) -> list[dict[str, Any]]:
+    """copy dataset `multiplier` times to get "big" data"""
+
+    return load_beers() * multiplier
+
+
+def __getattr__(name: str) -> Any:
+    # `from utils import beers` keeps working, but nothing is
+    # fetched until somebody actually asks for it
+    if name == "beers":
+        return get_beers()
+    msg = f"module {__name__!r} has no attribute {name!r}"
+    raise AttributeError(msg)
 
 
 # --> Time and memory profiler
 #
 def profile(fn: Callable[..., Any]) -> Callable[..., Any]:
-    """Calls input function fn twice, once to time profile and
-    once to memory profile"""
+    """Runs fn once, recording time per phase, peak traced memory, rows
+    and bytes sent (see instrument.py), and what it cost the server it
+    was given a connection to (see server_stats.py), and prints the
+    record as json"""
 
     @wraps(fn)
     def inner(*args: Any, **kwargs: Any) -> Any:
-        fn_kwargs_str = ", ".join(f"{k}={v}" for k, v in kwargs.items())
-        print(f"\n{fn.__name__}({fn_kwargs_str})")
-
-        # Measure time
-        t = time.perf_counter()
-        retval = fn(*args, **kwargs)
-        elapsed = time.perf_counter() - t
-        print(f"Time   {elapsed:0.4}")
-
-        # Measure memory
-        mem, retval = memory_usage(
-            (fn, args, kwargs), retval=True, timeout=200, interval=1e-7
-        )
-
-        print(f"Memory {max(mem) - min(mem)}")
+        with measure(fn.__name__, kwargs, server_costs(args[0]) if args else None):
+            retval = fn(*args, **kwargs)
+        print(json.dumps(RECORDS[-1]))
         return retval
 
     return inner
@@ -87,29 +151,7 @@ def profile(fn: Callable[..., Any]) -> Callable[..., Any]:
 EitherConnection = psycopg2.extensions.connection | psycopg.Connection
 
 def create_staging_table(cursor: EitherConnection) -> None:
-    cursor.execute(
-        """
-        DROP TABLE IF EXISTS staging_beers;
-        CREATE UNLOGGED TABLE staging_beers (
-            id                  INTEGER,
-            name                TEXT,
-            tagline             TEXT,
-            first_brewed        DATE,
-            description         TEXT,
-            image_url           TEXT,
-            abv                 DECIMAL,
-            ibu                 DECIMAL,
-            target_fg           DECIMAL,
-            target_og           DECIMAL,
-            ebc                 DECIMAL,
-            srm                 DECIMAL,
-            ph                  DECIMAL,
-            attenuation_level   DECIMAL,
-            brewers_tips        TEXT,
-            contributed_by      TEXT,
-            volume              INTEGER
-        );"""
-    )
+    cursor.execute(STAGING_BEERS.ddl())
 
 
 @profile
@@ -121,34 +163,12 @@ def insert_one_by_one(
 
     with connection.cursor() as cursor:
         create_staging_table(cursor)
-        for beer in beers:
-            cursor.execute(
-                """
-                INSERT INTO staging_beers VALUES (
-                    %(id)s,
-                    %(name)s,
-                    %(tagline)s,
-                    %(first_brewed)s,
-                    %(description)s,
-                    %(image_url)s,
-                    %(abv)s,
-                    %(ibu)s,
-                    %(target_fg)s,
-                    %(target_og)s,
-                    %(ebc)s,
-                    %(srm)s,
-                    %(ph)s,
-                    %(attenuation_level)s,
-                    %(brewers_tips)s,
-                    %(contributed_by)s,
-                    %(volume)s
-                );""",
-                {
-                    **beer,
-                    "first_brewed": parse_first_brewed(beer["first_brewed"]),
-                    "volume": beer["volume"]["value"],
-                },
-            )
+        insert = STAGING_BEERS.insert_statement()
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        for row in rows:
+            # parameter encoding happens inside execute, so it counts as wire
+            with phase("wire"):
+                cursor.execute(insert, row)
 
 
 @profile
@@ -161,35 +181,11 @@ def insert_executemany(
     with connection.cursor() as cursor:
         create_staging_table(cursor)
 
-        cursor.executemany("""
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );""",
-            [
-                {
-                    **beer,
-                    "first_brewed": parse_first_brewed(beer["first_brewed"]),
-                    "volume": beer["volume"]["value"],
-                }
-                for beer in beers
-            ],
+        rows = list(
+            phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
         )
+        with phase("wire"):
+            cursor.executemany(STAGING_BEERS.insert_statement(), rows)
 
 
 @profile
@@ -199,46 +195,228 @@ def insert_executemany_iterator(
     with connection.cursor() as cursor:
         create_staging_table(cursor)
 
-        cursor.executemany("""
-            INSERT INTO staging_beers VALUES (
-                %(id)s,
-                %(name)s,
-                %(tagline)s,
-                %(first_brewed)s,
-                %(description)s,
-                %(image_url)s,
-                %(abv)s,
-                %(ibu)s,
-                %(target_fg)s,
-                %(target_og)s,
-                %(ebc)s,
-                %(srm)s,
-                %(ph)s,
-                %(attenuation_level)s,
-                %(brewers_tips)s,
-                %(contributed_by)s,
-                %(volume)s
-            );
-            """,
-            # insert_executemany_iterator uses parents to get a generator
-            # insert_executemany uses square-brackets to pre-compute the entire list
-            (
-                {
-                    **beer,
-                    "first_brewed": parse_first_brewed(beer["first_brewed"]),
-                    "volume": beer["volume"]["value"],
-                }
-                for beer in beers
-            ),
-        )
+        with phase("wire"):
+            cursor.executemany(
+                STAGING_BEERS.insert_statement(),
+                # insert_executemany_iterator hands over a generator
+                # insert_executemany pre-computes the entire list
+                phased(
+                    "transform",
+                    (STAGING_BEERS.extract(beer) for beer in beers),
+                    count_rows=True,
+                ),
+            )
+
+
+# a Bind message counts its parameters in an int16
+MAX_PARAMETERS = 65_535
+
+# batch sizes already tuned, by (driver, host), so a rerun doesn't tune again
+_TUNED_BATCH_ROWS: dict[tuple[str, str], int] = {}
+
+
+def max_batch_rows(columns: int = len(STAGING_BEERS.columns)) -> int:
+    return MAX_PARAMETERS // columns
+
+
+def _insert_statement(cursor: Any, rows: int, prepared: bool) -> str:
+    """A `rows` row insert for the cursor. A psycopg2 cursor has no
+    prepare=True, so a prepared one is PREPAREd here and the statement
+    is the EXECUTE that runs it"""
+
+    if isinstance(cursor, psycopg.RawCursor):
+        return STAGING_BEERS.insert_statement(rows, numbered=True)
+    if not prepared:
+        return STAGING_BEERS.insert_statement(rows)
+    name = f"{STAGING_BEERS.table}_insert_{rows}"
+    cursor.execute(f"PREPARE {name} AS {STAGING_BEERS.insert_statement(rows, numbered=True)}")
+    return f"EXECUTE {name} ({', '.join(['%s'] * rows * len(STAGING_BEERS.columns))})"
+
+
+def tune_batch_rows(
+    insert_batch: Callable[[list[tuple[Any, ...]]], None],
+    rows: Iterator[tuple[Any, ...]],
+    start: int = 16,
+    limit: int | None = None,
+    probes: int = 3,
+) -> int:
+    """Insert `probes` batches each of start, 2*start, ... rows (up to
+    limit) from rows, timing every round trip, and stop doubling once the
+    best rows/s of a size improves on the last by less than 10%. The first
+    run of a prepared statement also pays for preparing it, taking the
+    best of a few leaves that out. Returns the best size seen, the rows
+    used for probing do get inserted."""
+
+    limit = limit or max_batch_rows()
+    best_rows, best_rate = start, 0.0
+    size = min(start, limit)
+    while True:
+        rate = 0.0
+        for _ in range(probes):
+            batch = list(islice(rows, size))
+            if len(batch) < size:
+                # out of rows, whatever is left still goes in
+                if batch:
+                    insert_batch(batch)
+                return best_rows
+            t = time.perf_counter()
+            insert_batch(batch)
+            rate = max(rate, size / (time.perf_counter() - t))
+        if rate < best_rate * 1.1:
+            break
+        best_rows, best_rate = size, rate
+        if size == limit:
+            break
+        size = min(size * 2, limit)
+    return best_rows
+
+
+@profile
+def insert_multirow(
+    connection: EitherConnection,
+    beers: list[dict[str, Any]],
+    batch_rows: int | None = None,
+    prepare: bool = True,
+    pipeline: bool = True,
+) -> None:
+    """For when COPY isn't available (some poolers and proxies): one
+    INSERT ... VALUES (...), (...), ... per batch_rows rows
+
+    Every full batch runs the same statement, so it's prepared once on the
+    server and then only executed (psycopg's prepare=True, or a PREPARE /
+    EXECUTE pair with psycopg2). With psycopg3, pipeline=True sends the
+    batches without waiting for each one's result. batch_rows=None tunes
+    the size on the first batches (see tune_batch_rows) and remembers it
+    for this host. The size used ends up in the profile record's notes.
+    """
+
+    psycopg3 = isinstance(connection, psycopg.Connection)
+    key = (type(connection).__module__, connection.info.host)
+    limit = max_batch_rows()
+    if batch_rows is not None and not 0 < batch_rows <= limit:
+        msg = f"batch_rows must be between 1 and {limit}, not {batch_rows}"
+        raise ValueError(msg)
+
+    # psycopg only caches the parsing of %s queries up to 4kB, longer ones
+    # are parsed on every execute. A RawCursor takes $1, $2, ... as they are
+    cursor_context = psycopg.RawCursor(connection) if psycopg3 else connection.cursor()
+    with cursor_context as cursor:
+        create_staging_table(cursor)
+        rows = phased("transform", map(STAGING_BEERS.extract, beers), count_rows=True)
+        statements: dict[tuple[int, bool], str] = {}
+
+        def insert_batch(batch: list[tuple[Any, ...]], prepared: bool = False) -> None:
+            with phase("encode"):
+                params = list(chain.from_iterable(batch))
+            with phase("wire"):
+                shape = (len(batch), prepared)
+                if shape not in statements:
+                    statements[shape] = _insert_statement(cursor, len(batch), prepared)
+                if psycopg3:
+                    cursor.execute(statements[shape], params, prepare=prepared)
+                else:
+                    cursor.execute(statements[shape], params)
+
+        try:
+            if batch_rows is None:
+                if key not in _TUNED_BATCH_ROWS:
+                    _TUNED_BATCH_ROWS[key] = tune_batch_rows(
+                        partial(insert_batch, prepared=prepare), rows, limit=limit
+                    )
+                batch_rows = _TUNED_BATCH_ROWS[key]
+            note("batch_rows", batch_rows)
+
+            batches = iter(lambda: list(islice(rows, batch_rows)), [])
+            # the pipeline waits for the results when it's closed, charge that to wire
+            pipelined = connection.pipeline() if psycopg3 and pipeline else nullcontext()
+            with phase("wire"), pipelined:
+                for batch in batches:
+                    # the last, short batch isn't worth preparing
+                    insert_batch(batch, prepared=prepare and len(batch) == batch_rows)
+        finally:
+            # psycopg2's PREPAREs outlive the load, a rerun would clash with them
+            for (_, prepared), statement in statements.items():
+                if prepared and not psycopg3:
+                    cursor.execute("DEALLOCATE " + statement.split()[1])
 
 
 # --> Change a value to a string for a column in a CSV file
 
+# the COPY options that clean_csv_value escapes for, text format with
+# DELIMITER '|'. Use copy_statement(TEXT_COPY_OPTIONS) for its output
+TEXT_COPY_OPTIONS = "DELIMITER '|'"
+
+# what has to be backslash-escaped in text format COPY data with
+# DELIMITER '|'. One translate, so the backslashes added for the others
+# don't get escaped again
+_TEXT_COPY_ESCAPES = str.maketrans(
+    {"\\": "\\\\", "|": "\\|", "\t": "\\t", "\r": "\\r", "\n": "\\n"}
+)
+
+
 def clean_csv_value(value: Any | None) -> str:
-    """Stringify a possibly-null, possibly embedded-newlines-text value
-    for copy from csv operations"""
+    """Stringify a possibly-null value for text format COPY with
+    DELIMITER '|' (not csv, despite the name): backslashes, the
+    delimiter, tabs and line breaks in text get escaped"""
 
     if value is None:
         return r"\N"
-    return str(value).replace("\n", "\\n")
+    if type(value) is str:
+        return value.translate(_TEXT_COPY_ESCAPES)
+    return str(value)
+
+
+# --> Streaming COPY data out of an iterator of bytes, for either driver
+
+class BytesIteratorIO(io.RawIOBase):
+    """Read-only file over an iterator of bytes (one COPY line each, say)
+
+    Small chunks are appended to one bytearray until a read can be
+    filled, and readinto() copies out of it through a memoryview. So a
+    read of many rows costs one copy, no joins and no per-row slicing.
+    """
+
+    def __init__(self: Self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._pending = bytearray()
+
+    def readable(self: Self) -> bool:
+        return True
+
+    def _fill(self: Self, size: int) -> int:
+        pending = self._pending
+        for chunk in self._chunks:
+            pending += chunk
+            if len(pending) >= size:
+                break
+        return min(size, len(pending))
+
+    def readinto(self: Self, buffer: Any) -> int:
+        target = memoryview(buffer).cast("B")
+        n = self._fill(len(target))
+        target[:n] = memoryview(self._pending)[:n]
+        # deleting from the front of a bytearray doesn't move the rest
+        del self._pending[:n]
+        return n
+
+    def read(self: Self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return self.readall()
+        n = self._fill(size)
+        data = bytes(memoryview(self._pending)[:n])
+        del self._pending[:n]
+        return data
+
+
+def iter_coalesced(chunks: Iterable[bytes], buffer_size: int = 2**16) -> Iterator[bytearray]:
+    """The chunks packed into writes of at least buffer_size bytes (bar the
+    last one), for psycopg's copy.write"""
+
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) >= buffer_size:
+            yield pending
+            pending = bytearray()
+    if pending:
+        yield pending
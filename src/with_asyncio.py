@@ -0,0 +1,143 @@
+"""
+Overlap the API crawl with the database load: pages are fetched
+concurrently, handed through bounded queues to a transform step, and the
+transformed rows go straight into an AsyncCopy. Nothing waits for the
+whole dataset to be downloaded.
+
+Only the transform gets a phase in the @profile record: the stages
+interleave at every await, and phases have to nest, so the fetching
+and the COPY end up as "other".
+"""
+
+import asyncio
+from collections import deque
+
+import psycopg
+import requests
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, phase
+from schema import STAGING_BEERS
+from utils import PUNKAPI_URL, get_page, profile
+
+"""
+
+    Functions you will need to edit at the top
+
+"""
+
+
+async def open_async_connection() -> psycopg.AsyncConnection:
+    connection = await psycopg.AsyncConnection.connect(
+        host="localhost", dbname="testload", user="jlc", password=None, autocommit=True
+    )
+    # the api's floats go into NUMERIC columns
+    register_float_numeric_dumpers(connection)
+    return connection
+
+
+# --> Pipeline stages, each one reads from the queue to its left and
+#     ends by putting a None on the queue to its right
+
+async def fetch_pages(
+    pages: asyncio.Queue,
+    url: str,
+    page_size: int,
+    concurrency: int,
+) -> None:
+    """Keep `concurrency` page requests in flight, but hand the pages on in
+    order, and stop at the first empty page"""
+
+    session = requests.Session()
+    in_flight: deque[asyncio.Task] = deque()
+    next_page = 1
+
+    def schedule() -> None:
+        nonlocal next_page
+        in_flight.append(
+            asyncio.create_task(
+                asyncio.to_thread(get_page, session, url, next_page, page_size)
+            )
+        )
+        next_page += 1
+
+    try:
+        for _ in range(concurrency):
+            schedule()
+        while in_flight:
+            data = await in_flight.popleft()
+            if not data:
+                break
+            await pages.put(data)
+            schedule()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        await pages.put(None)
+
+
+async def transform_pages(pages: asyncio.Queue, rows: asyncio.Queue) -> None:
+    while (page := await pages.get()) is not None:
+        # no await inside, so nothing else runs during the phase
+        with phase("transform"):
+            batch = [STAGING_BEERS.extract(beer) for beer in page]
+        await rows.put(batch)
+    await rows.put(None)
+
+
+async def copy_rows(connection: psycopg.AsyncConnection, rows: asyncio.Queue) -> int:
+    count = 0
+    async with connection.cursor() as cursor:
+        async with cursor.copy(STAGING_BEERS.copy_statement()) as copy:
+            copy.set_types(STAGING_BEERS.types)
+            while (batch := await rows.get()) is not None:
+                for row in batch:
+                    await copy.write_row(row)
+                count += len(batch)
+                add_rows(len(batch))
+    return count
+
+
+async def load_from_api(
+    url: str = PUNKAPI_URL,
+    page_size: int = 25,
+    concurrency: int = 8,
+    queue_size: int = 16,
+) -> int:
+    """Run the three stages together, returns the number of rows copied"""
+
+    pages: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    rows: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    async with await open_async_connection() as connection:
+        await connection.execute(STAGING_BEERS.ddl())
+
+        # if any stage fails, gather raises and the others get cancelled
+        # rather than waiting forever on a queue nobody will fill
+        stages = [
+            asyncio.create_task(fetch_pages(pages, url, page_size, concurrency)),
+            asyncio.create_task(transform_pages(pages, rows)),
+            asyncio.create_task(copy_rows(connection, rows)),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+    return stages[-1].result()
+
+
+@profile
+def copy_from_api_async(
+    url: str = PUNKAPI_URL,
+    page_size: int = 25,
+    concurrency: int = 8,
+    queue_size: int = 16,
+) -> int:
+    return asyncio.run(
+        load_from_api(
+            url=url,
+            page_size=page_size,
+            concurrency=concurrency,
+            queue_size=queue_size,
+        )
+    )
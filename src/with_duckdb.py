@@ -4,37 +4,39 @@ Let's try some modern ways of collecting data and see how psycopg does
 
 
 import json
-from collections.abc import Sequence
+from collections.abc import Iterable
+from itertools import chain
 from typing import Any
 
 import duckdb
 import psycopg
+from float_numeric import register_float_numeric_dumpers
+from instrument import add_rows, metered_copy, phase, phased
+from pgpq import ArrowToPostgresBinaryEncoder
+from psycopg.conninfo import make_conninfo
+from schema import STAGING_BEERS
+from transforms import STAGING_SCHEMA, cast_batch
 from utils import create_staging_table, profile
 
 
-def save_beers_json(beers: Sequence[dict[str,Any]]) -> None:
-    with open("beers.json", "w") as fp:
+def save_beers_json(
+    beers: Iterable[dict[str,Any]], path: str = "beers.json"
+) -> None:
+    with open(path, "w") as fp:
         fp.writelines(json.dumps(beer) + "\n" for beer in beers)
 
 
-def save_beers_parquet() -> None:
+def save_beers_parquet(
+    json_path: str = "beers.json", parquet_path: str = "beers.parquet"
+) -> None:
     with duckdb.connect(":memory:") as ddb:
-        ddb.sql("""SELECT * from 'beers.json' """).write_parquet('beers.parquet')
+        ddb.sql(f"""SELECT * from '{json_path}' """).write_parquet(parquet_path)
 
 
-@profile
-def copy_with_duckdb(db_conn : psycopg.Connection, whichfile: str) -> None:
-
-    with duckdb.connect(":memory:") as ddb:
-
-        create_staging_table(db_conn)
-
-        cleaned_beers = ddb.sql(f"""SELECT
-            id,        -- 1
-            name,      -- 2
-            tagline,   -- 3
-
-            case
+# duckdb expressions for the staging_beers columns that need cleaning up,
+# everything else is selected as is
+DUCKDB_EXPRESSIONS = {
+    "first_brewed": """case
                 -- YYYY to YYYY-01-01
                 when strlen(first_brewed) = 4
                 then first_brewed || '-01-01'
@@ -51,71 +53,136 @@ def copy_with_duckdb(db_conn : psycopg.Connection, whichfile: str) -> None:
                 when first_brewed is not NULL
                 then 'unexpected data format ' || first_brewed
 
-            end::date
-                AS first_brewed,  -- 4
-
-            description,   -- 5
-            image_url,     -- 6
-            abv,           -- 7
-            ibu,           -- 8
-            target_fg,     -- 9
-            target_og,     -- 10
-            ebc,           -- 11
-            srm,           -- 12
-            ph,            -- 13
-            attenuation_level,  -- 14
-            brewers_tips,       -- 15
-            contributed_by,         -- 16
-            volume.value AS volume  -- 17
+            end::date""",
+    "volume": "volume.value",
+}
+
+
+# duckdb types matching transforms.ARROW_TYPES, so a typed query comes
+# out as arrow batches pgpq can encode. Except NUMERIC: DECIMAL(38, 6)
+# would round anything finer, transforms.cast_batch checks the floats
+DUCKDB_TYPES = {
+    "integer": "INTEGER",
+    "text": "VARCHAR",
+    "date": "DATE",
+    "numeric": "DOUBLE",
+}
+
+
+def staging_beers_query(whichfile: str, typed: bool = False) -> str:
+    """SELECT the staging_beers columns, in table order, out of a json or
+    parquet file of api records. typed=True casts every column to its
+    DUCKDB_TYPES type instead of leaving the json types"""
+
+    select_list = ",\n            ".join(
+        (
+            f"({DUCKDB_EXPRESSIONS.get(column.name, column.name)})::{DUCKDB_TYPES[column.type]}"
+            if typed
+            else DUCKDB_EXPRESSIONS.get(column.name, column.name)
+        )
+        + f" AS {column.name}"
+        for column in STAGING_BEERS.columns
+    )
+    return f"""SELECT
+            {select_list}
         FROM '{whichfile}'
-        """)
+        """
+
+
+@profile
+def copy_with_duckdb(
+    db_conn : psycopg.Connection,
+    whichfile: str,
+    binary: bool = False,
+    numeric_from_float: bool = True,
+    batch_size: int = 10_000,
+) -> None:
+    """binary and numeric_from_float work like in
+    psycopg_implementation.copy_tuple_iterator, duckdb hands back
+    the DECIMAL columns as floats. Rows come out of duckdb
+    `batch_size` at a time"""
+
+    with duckdb.connect(":memory:") as ddb:
+
+        create_staging_table(db_conn)
+
+        cleaned_beers = ddb.execute(staging_beers_query(whichfile))
 
         with db_conn.cursor() as cursor:
-            with cursor.copy("""
-                COPY staging_beers(
-                    id,             -- 1
-                    name,           -- 2
-                    tagline,        -- 3
-                    first_brewed,   -- 4
-                    description,    -- 5
-                    image_url,      -- 6
-                    abv,            -- 7
-                    ibu,            -- 8
-                    target_fg,      -- 9
-                    target_og,      -- 10
-                    ebc,            -- 11
-                    srm,            -- 12
-                    ph,             -- 13
-                    attenuation_level,  -- 14
-                    brewers_tips,       -- 15
-                    contributed_by,     -- 16
-                    volume              -- 17
-                )
-                FROM STDIN"""
+            if numeric_from_float:
+                register_float_numeric_dumpers(cursor)
+            with metered_copy(
+                cursor, STAGING_BEERS.copy_statement("FORMAT BINARY" if binary else "")
             ) as copy:
-                copy.set_types(
-                    (
-                        "integer",  # 1
-                        "text",  # 2
-                        "text",  # 3
-                        "date",  # 4
-                        "text",  # 5
-                        "text",  # 6
-                        "numeric",  # 7
-                        "numeric",  # 8
-                        "numeric",  # 9
-                        "numeric",  # 10
-                        "numeric",  # 11
-                        "numeric",  # 12
-                        "numeric",  # 13
-                        "numeric",  # 14
-                        "text",  # 15
-                        "text",  # 16
-                        "integer",  # 17
-                    )
-                )
-
-                row = cleaned_beers.fetchone()
-                while row is not None:
+                copy.set_types(STAGING_BEERS.types)
+
+                # duckdb does the cleaning, so fetching a row is the transform
+                batches = iter(lambda: cleaned_beers.fetchmany(batch_size), [])
+                rows = phased("transform", chain.from_iterable(batches), count_rows=True)
+                for row in rows:
                     copy.write_row(row)
-                    row = cleaned_beers.fetchone()
+
+
+@profile
+def copy_with_duckdb_arrow(
+    db_conn: psycopg.Connection,
+    whichfile: str,
+    batch_size: int = 65_536,
+) -> None:
+    """duckdb cleans and types the columns and hands them over as arrow
+    record batches, pgpq turns each batch into binary COPY data. Nothing
+    runs in python per row"""
+
+    encoder = ArrowToPostgresBinaryEncoder(STAGING_SCHEMA)
+
+    with duckdb.connect(":memory:") as ddb:
+
+        create_staging_table(db_conn)
+
+        reader = ddb.execute(staging_beers_query(whichfile, typed=True)).to_arrow_reader(
+            batch_size
+        )
+        with db_conn.cursor() as cursor:
+            with metered_copy(cursor, STAGING_BEERS.copy_statement("FORMAT BINARY")) as copy:
+                copy.write(encoder.write_header())
+                for batch in phased("transform", map(cast_batch, reader)):
+                    add_rows(batch.num_rows)
+                    with phase("encode"):
+                        data = encoder.write_batch(batch)
+                    copy.write(data)
+                copy.write(encoder.finish())
+
+
+@profile
+def insert_with_duckdb_attach(db_conn: psycopg.Connection, whichfile: str) -> None:
+    """Let duckdb write into postgres itself: ATTACH the database with the
+    postgres extension and INSERT INTO ... SELECT. db_conn only creates
+    the table and lends its connection parameters
+
+    The extension is downloaded on first use (INSTALL postgres), so this
+    needs network access once.
+    """
+
+    create_staging_table(db_conn)
+    conninfo = make_conninfo(db_conn.info.dsn, password=db_conn.info.password)
+
+    with duckdb.connect(":memory:") as ddb:
+        ddb.execute("INSTALL postgres")
+        ddb.execute("LOAD postgres")
+        conninfo = conninfo.replace("'", "''")
+        ddb.execute(f"ATTACH '{conninfo}' AS pg (TYPE postgres)")
+        with phase("wire"):
+            # duckdb answers an INSERT with the number of rows inserted
+            (count,) = ddb.execute(
+                f"INSERT INTO pg.{STAGING_BEERS.table} ({', '.join(STAGING_BEERS.names)}) "
+                + staging_beers_query(whichfile)
+            ).fetchone()
+        add_rows(count)
+
+
+# extra keyword combinations for python -m bench to run
+BENCH_VARIANTS = {
+    "copy_with_duckdb": [
+        {"binary": True},
+    ],
+}
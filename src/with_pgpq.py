@@ -0,0 +1,52 @@
+"""
+Parquet -> Arrow record batches -> pgpq binary COPY buffers -> postgres
+
+No python tuple is ever built for a row: the column clean-up is done with
+pyarrow compute kernels and pgpq encodes whole batches in rust
+"""
+
+from collections.abc import Callable, Iterable
+
+import psycopg
+import pyarrow as pa
+import pyarrow.parquet as pq
+from instrument import add_rows, metered_copy, phase, phased
+from pgpq import ArrowToPostgresBinaryEncoder
+from schema import STAGING_BEERS
+from transforms import STAGING_SCHEMA, to_staging_batch
+from utils import create_staging_table, profile
+
+
+@profile
+def copy_with_pgpq(
+    db_conn: psycopg.Connection,
+    whichfile: str = "beers.parquet",
+    batch_size: int = 65_536,
+) -> None:
+    """Stream record batches from the parquet file into a binary COPY"""
+
+    parquet_file = pq.ParquetFile(whichfile)
+
+    create_staging_table(db_conn)
+
+    with db_conn.cursor() as cursor:
+        copy_batches(cursor, parquet_file.iter_batches(batch_size=batch_size))
+
+
+def copy_batches(
+    cursor: psycopg.Cursor,
+    batches: Iterable[pa.RecordBatch],
+    convert: Callable[[pa.RecordBatch], pa.RecordBatch] = to_staging_batch,
+) -> None:
+    """Binary COPY batches into staging_beers, `convert` turns each one
+    into STAGING_SCHEMA (the default takes raw api records)"""
+
+    encoder = ArrowToPostgresBinaryEncoder(STAGING_SCHEMA)
+    with metered_copy(cursor, STAGING_BEERS.copy_statement("FORMAT BINARY")) as copy:
+        copy.write(encoder.write_header())
+        for batch in phased("transform", map(convert, batches)):
+            add_rows(batch.num_rows)
+            with phase("encode"):
+                data = encoder.write_batch(batch)
+            copy.write(data)
+        copy.write(encoder.finish())